@@ -1,21 +1,1851 @@
 #!/usr/bin/env python3
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 import json
 from urllib.parse import urlparse, parse_qs
 import urllib.request
+import urllib.error
 import os
 import random
 import time
 from datetime import datetime, timedelta
 import ssl
+import threading
+import functools
+import contextlib
+import heapq
+import math
+from operator import itemgetter
+import argparse
+import csv
+import queue
+import sys
+import traceback
+import gzip
+import signal
+import socket
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import mmap
+import sqlite3
+import struct
+import unicodedata
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import deque, OrderedDict
+
+
+class MetricsRegistry:
+    """Thread-safe Prometheus-style counters, gauges and latency histograms"""
+    
+    # Upper bounds (seconds) of the latency histogram buckets; +Inf is implicit
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, prefix='smartcommute'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket_counts, sum, count]
+        self.gauges = {}      # name -> callable returning the current value
+        self.help = {}
+    
+    def describe(self, name, kind, text):
+        """Register the TYPE and HELP lines for a metric"""
+        self.help[name] = (kind, text)
+    
+    def inc(self, name, labels=(), amount=1):
+        """Increment a counter; labels is a tuple of (key, value) pairs"""
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, labels, value):
+        """Record one sample in a latency histogram"""
+        index = bisect_left(self.LATENCY_BUCKETS, value)
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.LATENCY_BUCKETS) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def gauge(self, name, callback):
+        """Register a gauge whose value is read at scrape time; the callback may return
+        {labels: value} for a labelled family"""
+        self.gauges[name] = callback
+    
+    @staticmethod
+    def format_labels(labels, extra=None):
+        """Format label pairs as {key="value",...}"""
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        body = []
+        for key, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            body.append(f'{key}="{value}"')
+        return '{' + ','.join(body) + '}'
+    
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self.histograms.items())
+        
+        lines = []
+        described = set()
+        
+        def header(name):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self.help.get(name, ('untyped', ''))
+            lines.append(f"# HELP {self.prefix}_{name} {text}")
+            lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+        
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{self.prefix}_{name}{self.format_labels(labels)} {value}")
+        
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket_count
+                lines.append(f"{self.prefix}_{name}_bucket{self.format_labels(labels, ('le', bound))} {cumulative}")
+            lines.append(f"{self.prefix}_{name}_sum{self.format_labels(labels)} {total:.6f}")
+            lines.append(f"{self.prefix}_{name}_count{self.format_labels(labels)} {count}")
+        
+        for name, callback in sorted(self.gauges.items()):
+            header(name)
+            value = callback()
+            if isinstance(value, dict):
+                for labels, labelled_value in sorted(value.items()):
+                    lines.append(f"{self.prefix}_{name}{self.format_labels(labels)} {labelled_value}")
+            else:
+                lines.append(f"{self.prefix}_{name} {value}")
+        
+        return '\n'.join(lines) + '\n'
+
+
+class NullSpan:
+    """Span returned when tracing is off or the request was not sampled"""
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+    
+    def set(self, key, value):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """A timed stage of a traced request; nests under whichever span is open"""
+    
+    __slots__ = ('trace', 'name', 'attrs', 'span_id', 'parent_id', 'started')
+    
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+    
+    def __enter__(self):
+        stack = self.trace['stack']
+        self.parent_id = stack[-1] if stack else None
+        self.span_id = len(self.trace['spans'])
+        self.trace['spans'].append(None)  # reserve the slot so ids follow start order
+        stack.append(self.span_id)
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        ended = time.perf_counter()
+        self.trace['stack'].pop()
+        if exc is not None:
+            self.attrs['error'] = repr(exc)
+        self.trace['spans'][self.span_id] = {
+            'id': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'startMs': round((self.started - self.trace['started']) * 1000, 3),
+            'durationMs': round((ended - self.started) * 1000, 3),
+            'attrs': self.attrs
+        }
+        return False
+    
+    def set(self, key, value):
+        self.attrs[key] = value
+
+
+class Tracer:
+    """Opt-in per-request span tracing into a ring buffer and an optional JSONL file"""
+    
+    def __init__(self, sample_rate=0.0, capacity=256, path=None, max_queue=10000):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.rng = random.Random()  # keep sampling off the schedule RNG
+        # Traces bound for the file are written by a background thread, as StructuredLogger does
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.dropped = 0
+        self.configure(sample_rate, capacity, path)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset_after_fork)
+    
+    def reset_after_fork(self):
+        """The writer thread does not survive fork; give the child a fresh queue and writer"""
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.writer = None
+        self.writer_lock = threading.Lock()
+    
+    def configure(self, sample_rate=0.0, capacity=256, path=None):
+        """Set the fraction of requests traced (0 disables tracing) and the sinks"""
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.path = path
+        self.capacity = capacity
+        with self.lock:
+            self.traces = deque(maxlen=capacity)
+    
+    def start(self, name, **attrs):
+        """Begin a trace for the current request if it is sampled"""
+        if self.sample_rate <= 0 or self.rng.random() >= self.sample_rate:
+            self.local.trace = None
+            return
+        self.local.trace = {
+            'name': name,
+            'attrs': attrs,
+            'timestamp': time.time(),
+            'started': time.perf_counter(),
+            'spans': [],
+            'stack': []
+        }
+    
+    def span(self, name, **attrs):
+        """Open a span under the current one; a no-op unless this request is traced"""
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return NULL_SPAN
+        return Span(trace, name, attrs)
+    
+    def finish(self, **attrs):
+        """Close the current trace and hand it to the sinks"""
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return
+        self.local.trace = None
+        
+        record = {
+            'name': trace['name'],
+            'timestamp': trace['timestamp'],
+            'durationMs': round((time.perf_counter() - trace['started']) * 1000, 3),
+            'attrs': dict(trace['attrs'], **attrs),
+            'spans': [span for span in trace['spans'] if span is not None]
+        }
+        with self.lock:
+            self.traces.append(record)
+        if self.path:
+            if self.writer is None:
+                self.start_writer()
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+    
+    def start_writer(self):
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name='trace-writer', daemon=True)
+                self.writer.start()
+    
+    def close(self, timeout=2.0):
+        """Flush queued traces to the file and stop the writer thread"""
+        if self.writer is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.writer.join(timeout)
+        self.writer = None
+    
+    def run(self):
+        sink = None
+        try:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                try:
+                    if sink is None:
+                        sink = open(self.path, 'a', encoding='utf-8')
+                    sink.write(json.dumps(record) + '\n')
+                    if self.queue.empty():
+                        sink.flush()
+                except Exception:
+                    pass  # an unwritable trace file must not kill the writer
+        finally:
+            if sink is not None:
+                sink.close()
+    
+    def recent(self, limit=50):
+        """Most recent traces, newest first"""
+        with self.lock:
+            traces = list(self.traces)
+        return traces[::-1][:limit]
+
+
+class StructuredLogger:
+    """Levelled key=value (or JSON lines) logger that writes from a background thread"""
+    
+    LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+    LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+    
+    def __init__(self, level='INFO', fmt='text', sample_rate=1.0, stream=None, max_queue=10000):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.local = threading.local()
+        self.rng = random.Random()  # keep sampling off the schedule RNG
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.dropped = 0
+        self.configure(level, fmt, sample_rate, stream)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset_after_fork)
+    
+    def reset_after_fork(self):
+        """The writer thread does not survive fork; give the child a fresh queue and writer"""
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.writer = None
+        self.writer_lock = threading.Lock()
+    
+    def configure(self, level='INFO', fmt='text', sample_rate=1.0, stream=None):
+        """Set the minimum level, output format ('text' or 'json') and per-request sample rate"""
+        self.level = self.LEVELS[level.upper()]
+        self.fmt = fmt
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.stream = stream  # None means sys.stdout, looked up when writing
+    
+    def sample_request(self, sampled=None):
+        """Decide once per request whether its sampled lines are written; pass sampled to reuse
+        another thread's decision"""
+        if sampled is None:
+            sampled = self.sample_rate >= 1.0 or self.rng.random() < self.sample_rate
+        self.local.sampled = sampled
+    
+    def request_sampled(self):
+        return getattr(self.local, 'sampled', True)
+    
+    def log(self, level, event, /, sampled=False, **fields):
+        """Queue a record; never blocks, drops the record if the writer is behind"""
+        if level < self.level:
+            return
+        if sampled and not getattr(self.local, 'sampled', True):
+            return
+        if self.writer is None:
+            self.start()
+        try:
+            self.queue.put_nowait((time.time(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+    
+    def debug(self, event, /, sampled=False, **fields):
+        self.log(10, event, sampled, **fields)
+    
+    def info(self, event, /, sampled=False, **fields):
+        self.log(20, event, sampled, **fields)
+    
+    def warning(self, event, /, sampled=False, **fields):
+        self.log(30, event, sampled, **fields)
+    
+    def error(self, event, /, sampled=False, **fields):
+        self.log(40, event, sampled, **fields)
+    
+    def exception(self, event, /, **fields):
+        """Log an error with the traceback of the exception being handled"""
+        fields['traceback'] = traceback.format_exc()
+        self.log(40, event, **fields)
+    
+    def start(self):
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name='log-writer', daemon=True)
+                self.writer.start()
+    
+    def close(self, timeout=2.0):
+        """Flush queued records and stop the writer thread"""
+        if self.writer is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.writer.join(timeout)
+        self.writer = None
+    
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(self.format(record))
+                if self.queue.empty():
+                    stream.flush()
+            except Exception:
+                pass  # a broken stdout must not kill the writer
+    
+    def format(self, record):
+        timestamp, level, event, fields = record
+        moment = datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')
+        if self.fmt == 'json':
+            return json.dumps(dict({'ts': moment, 'level': self.LEVEL_NAMES[level], 'event': event}, **fields), default=str) + '\n'
+        
+        trace = fields.pop('traceback', None)
+        parts = [moment, f"{self.LEVEL_NAMES[level]:<7}", event]
+        for key, value in fields.items():
+            value = str(value)
+            if not value or ' ' in value or '=' in value or '"' in value:
+                value = json.dumps(value)
+            parts.append(f"{key}={value}")
+        line = ' '.join(parts) + '\n'
+        if trace:
+            line += ''.join('    ' + trace_line + '\n' for trace_line in trace.rstrip().splitlines())
+        return line
+
+
+class UpstreamTape:
+    """Record upstream responses to a JSONL log, or replay them from one offline.
+    
+    Each record goes to the log in a single O_APPEND write (a gzip member of its own
+    for .gz logs), so pre-forked workers sharing the descriptor never interleave.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recording = False
+        self.replaying = False
+        self.sink = None  # file descriptor of the record log
+        self.compress = False
+        self.corrupt = None  # what cut the replayed capture short, if it was damaged
+        self.responses = {}  # key -> list of recorded entries
+        self.cursors = {}    # key -> index of the next entry to replay
+        self.replay_timing = False
+    
+    def configure(self, record_path=None, replay_path=None, replay_timing=False):
+        """Start recording to record_path or replaying from replay_path (.gz files are compressed)"""
+        self.close()
+        self.replay_timing = replay_timing
+        self.corrupt = None
+        if record_path:
+            self.sink = os.open(record_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.compress = record_path.endswith('.gz')
+            self.recording = True
+        if replay_path:
+            self.corrupt = self.load(replay_path)
+            self.replaying = True
+    
+    @staticmethod
+    def open(path, mode):
+        if path.endswith('.gz'):
+            return gzip.open(path, mode, encoding='utf-8')
+        return open(path, mode, encoding='utf-8')
+    
+    @staticmethod
+    def key(url):
+        """Identify a call by path and query, so a capture taken against stand-ins replays against any base URL"""
+        parsed = urlparse(url)
+        return f"{parsed.path}?{parsed.query}"
+    
+    def record(self, url, elapsed, body=None, error=None):
+        entry = {'key': self.key(url), 'at': round(time.time(), 3), 'ms': round(elapsed * 1000, 1)}
+        if error is None:
+            entry['body'] = body
+        else:
+            entry['error'] = error
+        data = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+        if self.compress:
+            data = gzip.compress(data, compresslevel=6)
+        with self.lock:
+            if self.sink is not None:
+                os.write(self.sink, data)
+    
+    def load(self, path):
+        """Read a capture; None, or a description of the corruption that cut it short"""
+        responses = {}
+        problem = None
+        with self.open(path, 'rt') as source:
+            try:
+                for line in source:
+                    if line.strip():
+                        entry = json.loads(line)
+                        responses.setdefault(entry['key'], []).append(entry)
+            except (EOFError, ValueError):
+                pass  # a capture cut short by a kill; keep everything before the torn record
+            except (zlib.error, OSError) as e:
+                problem = str(e)  # keep everything before the damage
+        with self.lock:
+            self.responses = responses
+            self.cursors = {}
+        return problem
+    
+    def replay(self, url):
+        """Return the next recorded body for url, cycling through the log; raise what was recorded"""
+        key = self.key(url)
+        with self.lock:
+            entries = self.responses.get(key)
+            if not entries:
+                raise urllib.error.URLError(f"no recorded response for {key}")
+            index = self.cursors.get(key, 0)
+            self.cursors[key] = (index + 1) % len(entries)
+            entry = entries[index]
+        if self.replay_timing:
+            time.sleep(entry['ms'] / 1000)
+        if 'error' in entry:
+            raise urllib.error.URLError(entry['error'])
+        return entry['body']
+    
+    def close(self):
+        with self.lock:
+            if self.sink is not None:
+                os.close(self.sink)
+            self.sink = None
+            self.recording = False
+            self.replaying = False
+
+
+class SharedWeatherCache:
+    """Weather entries in fixed-size slots of an anonymous shared mapping, so pre-forked
+    workers see each other's fetches.
+    
+    Each slot is a seqlock: the writer makes the sequence odd, writes, then makes it even
+    again; readers copy the slot without locking and retry if the sequence moved. Writers
+    are serialized by one cross-process lock. Keys hash to a slot and probe a few
+    neighbours; when all are taken the oldest entry is overwritten.
+    """
+    
+    HEADER = struct.Struct('<QHH4xd')  # sequence, key length, value length, stored_at
+    KEY_SIZE = 64
+    PROBES = 8
+    READ_RETRIES = 100
+    
+    def __init__(self, slots=256, slot_size=1024):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.value_size = slot_size - self.HEADER.size - self.KEY_SIZE
+        # Anonymous mappings are shared with children forked after this point
+        self.buffer = mmap.mmap(-1, slots * slot_size)
+        self.write_lock = multiprocessing.Lock()
+        self.decoded = {}  # key -> (sequence, weather dict, JSON bytes, stored_at), per process
+    
+    def slot_indexes(self, key_bytes):
+        start = zlib.crc32(key_bytes) % self.slots
+        return [(start + n) % self.slots for n in range(min(self.PROBES, self.slots))]
+    
+    def read_slot(self, index):
+        """(sequence, key bytes, value bytes, stored_at) from a consistent copy of a slot, or None"""
+        offset = index * self.slot_size
+        for _ in range(self.READ_RETRIES):
+            sequence, key_length, value_length, stored_at = self.HEADER.unpack_from(self.buffer, offset)
+            if sequence & 1:
+                continue  # a writer is mid-update
+            start = offset + self.HEADER.size
+            key = self.buffer[start:start + key_length]
+            value = self.buffer[start + self.KEY_SIZE:start + self.KEY_SIZE + value_length]
+            if self.HEADER.unpack_from(self.buffer, offset)[0] == sequence:
+                return sequence, key, value, stored_at
+        return None
+    
+    def write_slot(self, index, key_bytes, value_bytes, stored_at):
+        offset = index * self.slot_size
+        sequence = self.HEADER.unpack_from(self.buffer, offset)[0]
+        struct.pack_into('<Q', self.buffer, offset, sequence + 1)
+        start = offset + self.HEADER.size
+        self.buffer[start:start + len(key_bytes)] = key_bytes
+        self.buffer[start + self.KEY_SIZE:start + self.KEY_SIZE + len(value_bytes)] = value_bytes
+        self.HEADER.pack_into(self.buffer, offset, sequence + 2, len(key_bytes), len(value_bytes), stored_at)
+        return sequence + 2
+    
+    def get(self, key, max_age):
+        """(weather dict, JSON bytes, stored_at, decoded_here) for a fresh entry, or None.
+        
+        The dict is decoded once per write and then reused, so repeated hits return the
+        same object; decoded_here is True when this call had to decode another worker's write.
+        """
+        key_bytes = key.encode()
+        for index in self.slot_indexes(key_bytes):
+            slot = self.read_slot(index)
+            if slot is None:
+                return None
+            sequence, slot_key, value, stored_at = slot
+            if not slot_key:
+                return None  # probing stops at the first empty slot
+            if slot_key != key_bytes:
+                continue
+            if time.time() - stored_at >= max_age:
+                return None
+            memo = self.decoded.get(key)
+            if memo is not None and memo[0] == sequence:
+                return memo[1], memo[2], memo[3], False
+            weather_data = json.loads(value)
+            self.decoded[key] = (sequence, weather_data, value, stored_at)
+            return weather_data, value, stored_at, True
+        return None
+    
+    def put(self, key, weather_data, encoded, stored_at):
+        """Publish an entry to every worker; False if the key or value does not fit a slot"""
+        key_bytes = key.encode()
+        if len(key_bytes) > self.KEY_SIZE or len(encoded) > self.value_size:
+            return False
+        with self.write_lock:
+            target = None
+            oldest = None
+            for index in self.slot_indexes(key_bytes):
+                _, key_length, _, slot_stored_at = self.HEADER.unpack_from(self.buffer, index * self.slot_size)
+                start = index * self.slot_size + self.HEADER.size
+                if key_length == 0 or self.buffer[start:start + key_length] == key_bytes:
+                    target = index
+                    break
+                if oldest is None or slot_stored_at < oldest[1]:
+                    oldest = (index, slot_stored_at)
+            if target is None:
+                target = oldest[0]
+            sequence = self.write_slot(target, key_bytes, encoded, stored_at)
+        self.decoded[key] = (sequence, weather_data, encoded, stored_at)
+        return True
+    
+    def clear(self):
+        with self.write_lock:
+            for index in range(self.slots):
+                if self.HEADER.unpack_from(self.buffer, index * self.slot_size)[1]:
+                    self.write_slot(index, b'', b'', 0.0)
+        self.decoded = {}
+    
+    def __len__(self):
+        return sum(1 for index in range(self.slots)
+                   if self.HEADER.unpack_from(self.buffer, index * self.slot_size)[1])
+
+
+class PersistentCache:
+    """Fetched upstream data kept in SQLite with its fetch time, so a restart starts warm"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.connection = None
+        self.pid = None
+    
+    @property
+    def enabled(self):
+        return self.path is not None
+    
+    def configure(self, path=None):
+        self.close()
+        self.path = path
+        if path:
+            with self.lock:
+                db = self.connect()
+                db.execute('CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                           'value TEXT NOT NULL, stored_at REAL NOT NULL, PRIMARY KEY (namespace, key))')
+                db.commit()
+    
+    def connect(self):
+        # A SQLite connection must not be used across fork, so each process opens its own
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.pid = os.getpid()
+        return self.connection
+    
+    def put(self, namespace, key, value, stored_at):
+        """Insert or replace one entry; value is a JSON string"""
+        with self.lock:
+            db = self.connect()
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (namespace, key, value, stored_at))
+            db.commit()
+    
+    def load(self, namespace, max_age):
+        """{key: (value, stored_at)} for the entries stored less than max_age seconds ago"""
+        with self.lock:
+            rows = self.connect().execute('SELECT key, value, stored_at FROM entries WHERE namespace = ? AND stored_at > ?',
+                                          (namespace, time.time() - max_age)).fetchall()
+        return {key: (value, stored_at) for key, value, stored_at in rows}
+    
+    def clear(self):
+        with self.lock:
+            db = self.connect()
+            db.execute('DELETE FROM entries')
+            db.commit()
+    
+    def close(self):
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                self.connection.close()
+            self.connection = None
+            self.pid = None
+
+
+class RateLimiter:
+    """Token buckets per (client, endpoint class), kept in LRU order so bookkeeping is O(1).
+    
+    A bucket that has been idle long enough to refill completely is indistinguishable
+    from a new one, so those are evicted from the old end as requests come in; the
+    table is also capped at max_buckets.
+    """
+    
+    def __init__(self, max_buckets=10000):
+        self.lock = threading.Lock()
+        self.max_buckets = max_buckets
+        self.rules = {}  # endpoint class -> (tokens per second, burst)
+        self.buckets = OrderedDict()  # (client, endpoint class) -> [tokens, updated]
+        self.api_keys = frozenset()
+    
+    def configure(self, rules=None, max_buckets=10000, api_keys=None):
+        """Set {endpoint class: (rate per second, burst)}; classes without a rule are unlimited.
+        
+        Only api_keys get buckets of their own; any other X-API-Key is limited by IP, so
+        rotating made-up keys can neither dodge the limit nor flood the table.
+        """
+        with self.lock:
+            self.rules = dict(rules or {})
+            self.max_buckets = max_buckets
+            self.api_keys = frozenset(api_keys or ())
+            self.buckets = OrderedDict()
+    
+    @property
+    def enabled(self):
+        return bool(self.rules)
+    
+    def take(self, client, endpoint_class, cost=1):
+        """Spend cost tokens; 0.0 if allowed, else the seconds until enough will have refilled.
+        
+        A cost above the burst is capped at the burst (it needs a full bucket).
+        """
+        rule = self.rules.get(endpoint_class)
+        if rule is None:
+            return 0.0
+        rate, burst = rule
+        cost = min(cost, burst)
+        now = time.monotonic()
+        key = (client, endpoint_class)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                wait = 0.0
+            else:
+                wait = (cost - bucket[0]) / rate
+            self.evict(now)
+        return wait
+    
+    def evict(self, now):
+        while len(self.buckets) > self.max_buckets:
+            self.buckets.popitem(last=False)
+        while self.buckets:
+            (client, endpoint_class), (tokens, updated) = next(iter(self.buckets.items()))
+            rate, burst = self.rules.get(endpoint_class, (1.0, 0))
+            if tokens + (now - updated) * rate < burst:
+                break
+            self.buckets.popitem(last=False)
+    
+    def __len__(self):
+        return len(self.buckets)
+
+
+class AdmissionController:
+    """Bounded admission in front of the handlers.
+    
+    At most max_active requests run at once, and upstream-bound ones may hold only
+    upstream_share of those slots so cheap requests always have room. Up to max_queue
+    more wait, each for at most max_wait seconds; freed slots go to waiting cheap
+    requests first. Anything beyond that is turned away immediately.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+    
+    def configure(self, max_active=0, max_queue=64, max_wait=2.0, upstream_share=0.75):
+        """max_active=0 disables admission control"""
+        with self.lock:
+            self.max_active = max_active
+            self.max_queue = max_queue
+            self.max_wait = max_wait
+            self.upstream_limit = max(1, int(max_active * upstream_share))
+            self.active = {'cheap': 0, 'upstream': 0}
+            self.waiting = {'cheap': deque(), 'upstream': deque()}
+    
+    @property
+    def enabled(self):
+        return self.max_active > 0
+    
+    def can_start(self, priority):
+        if self.active['cheap'] + self.active['upstream'] >= self.max_active:
+            return False
+        return priority == 'cheap' or self.active['upstream'] < self.upstream_limit
+    
+    def acquire(self, priority):
+        """Wait for a slot; None once admitted, else why not ('queue_full', 'timeout' or 'displaced')"""
+        with self.lock:
+            if not self.waiting[priority] and self.can_start(priority):
+                self.active[priority] += 1
+                return None
+            if len(self.waiting['cheap']) + len(self.waiting['upstream']) >= self.max_queue:
+                if priority == 'upstream' or not self.waiting['upstream']:
+                    return 'queue_full'
+                # A cheap request takes the place of the most recent upstream-bound one
+                displaced = self.waiting['upstream'].pop()
+                displaced.outcome = 'displaced'
+                displaced.notify()
+            waiter = threading.Condition(self.lock)
+            waiter.outcome = None
+            self.waiting[priority].append(waiter)
+            deadline = time.monotonic() + self.max_wait
+            while waiter.outcome is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting[priority].remove(waiter)
+                    return 'timeout'
+                waiter.wait(remaining)
+            return None if waiter.outcome == 'admitted' else waiter.outcome
+    
+    def release(self, priority):
+        with self.lock:
+            self.active[priority] -= 1
+            # Hand freed slots to waiters, cheap ones first
+            for waiting_priority in ('cheap', 'upstream'):
+                waiters = self.waiting[waiting_priority]
+                while waiters and self.can_start(waiting_priority):
+                    waiter = waiters.popleft()
+                    waiter.outcome = 'admitted'
+                    self.active[waiting_priority] += 1
+                    waiter.notify()
+    
+    def queued(self):
+        return len(self.waiting['cheap']) + len(self.waiting['upstream'])
+    
+    def running(self):
+        return self.active['cheap'] + self.active['upstream']
+
+
+class BudgetExhausted(urllib.error.URLError):
+    """fetch_json refused to call an upstream whose call budget is spent"""
+
+
+class UpstreamBudget:
+    """Calls per upstream API per minute and per (UTC) day, shared by pre-forked workers.
+    
+    User-facing misses may spend the whole budget, background work (warm-up) only
+    background_share of it. Past low_watermark callers stretch their cache TTLs, and
+    once a budget is spent they serve whatever they have cached, however old.
+    """
+    
+    UPSTREAMS = ('open-meteo', 'tfl')
+    LOW_TTL_FACTOR = 4
+    
+    def __init__(self):
+        self.local = threading.local()
+        self.configure()
+    
+    def configure(self, limits=None, background_share=0.5, low_watermark=0.8):
+        """limits is {upstream: (calls per minute, calls per day)}; 0 or a missing entry means unlimited"""
+        self.limits = {name: (0, 0) for name in self.UPSTREAMS}
+        self.limits.update(limits or {})
+        self.enforced = any(per_minute or per_day for per_minute, per_day in self.limits.values())
+        self.background_share = background_share
+        self.low_watermark = low_watermark
+        # Per upstream: minute window, calls in it, day window, calls in it. Shared memory,
+        # created before any fork, so every worker draws on the same budget
+        self.counters = multiprocessing.RawArray('d', 4 * len(self.UPSTREAMS))
+        self.lock = multiprocessing.Lock()
+    
+    @contextlib.contextmanager
+    def background(self):
+        """Mark upstream calls made by this thread inside the block as background work"""
+        self.local.priority = 'background'
+        try:
+            yield
+        finally:
+            self.local.priority = 'user'
+    
+    def priority(self):
+        return getattr(self.local, 'priority', 'user')
+    
+    def counts(self, name):
+        """(calls this minute, calls today); call with the lock held"""
+        index = 4 * self.UPSTREAMS.index(name)
+        now = time.time()
+        minute, day = now // 60, now // 86400
+        if self.counters[index] != minute:
+            self.counters[index] = minute
+            self.counters[index + 1] = 0
+        if self.counters[index + 2] != day:
+            self.counters[index + 2] = day
+            self.counters[index + 3] = 0
+        return self.counters[index + 1], self.counters[index + 3]
+    
+    def peek(self, name):
+        """(calls this minute, calls today) read without the lock; a counter may be one call
+        behind, which is close enough for stretching TTLs"""
+        index = 4 * self.UPSTREAMS.index(name)
+        now = time.time()
+        minute_calls = self.counters[index + 1] if self.counters[index] == now // 60 else 0.0
+        day_calls = self.counters[index + 3] if self.counters[index + 2] == now // 86400 else 0.0
+        return minute_calls, day_calls
+    
+    def used(self, name, counts=None):
+        """Fraction of the tighter of the two budgets already spent; counts defaults to
+        counts(name), so the lock must be held unless they come from peek()"""
+        per_minute, per_day = self.limits[name]
+        minute_calls, day_calls = counts or self.counts(name)
+        return max(minute_calls / per_minute if per_minute else 0.0,
+                   day_calls / per_day if per_day else 0.0)
+    
+    def acquire(self, name):
+        """Count one call to upstream name; False, without counting, if this caller may not spend more"""
+        cap = self.background_share if self.priority() == 'background' else 1.0
+        with self.lock:
+            if self.used(name) >= cap:
+                return False
+            index = 4 * self.UPSTREAMS.index(name)
+            self.counters[index + 1] += 1
+            self.counters[index + 3] += 1
+            return True
+    
+    def ttl_factor(self, name):
+        """How much to stretch cache TTLs for data from upstream name: 1, LOW_TTL_FACTOR, or inf when spent"""
+        if not self.enforced:
+            return 1
+        # Checked on every cache hit, so skip the cross-process lock
+        used = self.used(name, self.peek(name))
+        if used >= 1.0:
+            return math.inf
+        if used >= self.low_watermark:
+            return self.LOW_TTL_FACTOR
+        return 1
+    
+    def retry_after(self, name):
+        """Whole seconds until upstream name's spent budget starts over: the next minute, or
+        the next UTC day if the daily budget is what ran out"""
+        per_minute, per_day = self.limits[name]
+        with self.lock:
+            minute_calls, day_calls = self.counts(name)
+        now = time.time()
+        if per_day and day_calls >= per_day:
+            return math.ceil(86400 - now % 86400)
+        return math.ceil(60 - now % 60)
+    
+    def snapshot(self):
+        """{(('upstream', name), ('window', 'minute'|'day')): calls} for the metrics gauge"""
+        with self.lock:
+            usage = {name: self.counts(name) for name in self.UPSTREAMS}
+        snapshot = {}
+        for name, (minute_calls, day_calls) in usage.items():
+            snapshot[(('upstream', name), ('window', 'minute'))] = int(minute_calls)
+            snapshot[(('upstream', name), ('window', 'day'))] = int(day_calls)
+        return snapshot
+
+
+class TimeSeriesHistory:
+    """Recent samples per (metric, key), bucketed at a fixed resolution in ring buffers.
+    
+    Each series is a set of parallel arrays with one entry per bucket (bucket number,
+    count, sum, min, max), allocated once, so recording is O(1) and memory is fixed at
+    about 24 bytes per slot per series. When the ring wraps, the oldest bucket is
+    reused. At most max_series series are tracked; samples for new ones beyond that
+    are counted as dropped.
+    """
+    
+    METRICS = ('bart_minutes', 'bart_delay', 'tfl_minutes', 'tfl_severity', 'temperature', 'aqi')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+    
+    def configure(self, resolution=60, slots=1440, max_series=1000):
+        """resolution is seconds per bucket; slots=0 disables recording"""
+        with self.lock:
+            self.resolution = resolution
+            self.slots = slots
+            self.max_series = max_series
+            self.series = {}
+            self.dropped = 0
+    
+    @property
+    def enabled(self):
+        return self.slots > 0
+    
+    def record(self, metric, key, value, at=None):
+        """Add one sample to the bucket for time at (default now); None values are ignored"""
+        if value is None or not self.enabled:
+            return
+        at = time.time() if at is None else at
+        bucket = int(at // self.resolution)
+        index = bucket % self.slots
+        with self.lock:
+            series = self.series.get((metric, key))
+            if series is None:
+                if len(self.series) >= self.max_series:
+                    self.dropped += 1
+                    return
+                series = self.series[(metric, key)] = (
+                    array('q', [-1]) * self.slots, array('I', [0]) * self.slots,
+                    array('f', [0.0]) * self.slots, array('f', [0.0]) * self.slots, array('f', [0.0]) * self.slots)
+            buckets, counts, sums, lows, highs = series
+            if buckets[index] != bucket:
+                buckets[index] = bucket
+                counts[index] = 1
+                sums[index] = lows[index] = highs[index] = value
+            else:
+                counts[index] += 1
+                sums[index] += value
+                lows[index] = min(lows[index], value)
+                highs[index] = max(highs[index], value)
+    
+    def query(self, metric, key, start=None, end=None):
+        """[(bucket start, count, mean, min, max)] for the buckets between start and end
+        (epoch seconds, default the whole window), or None for an unknown series"""
+        series = self.series.get((metric, key))
+        if series is None:
+            return None
+        buckets, counts, sums, lows, highs = series
+        last = int((time.time() if end is None else end) // self.resolution)
+        first = last - self.slots + 1
+        if start is not None:
+            first = max(first, int(start // self.resolution))
+        points = []
+        with self.lock:
+            for bucket in range(first, last + 1):
+                index = bucket % self.slots
+                if buckets[index] == bucket:
+                    points.append((bucket * self.resolution, counts[index], sums[index] / counts[index],
+                                   lows[index], highs[index]))
+        return points
+    
+    def keys(self):
+        """{metric: sorted keys} for every series recorded so far"""
+        with self.lock:
+            names = list(self.series)
+        listing = {}
+        for metric, key in sorted(names):
+            listing.setdefault(metric, []).append(key)
+        return listing
+    
+    def __len__(self):
+        return len(self.series)
+
+
+class ReliabilityStats:
+    """Rolling on-time statistics per (scope, key), e.g. ('line', 'YELLOW').
+    
+    The window is split into sub-windows, each holding a departure count, delay sum,
+    on-time count and a histogram of whole-minute delays. Recording a departure
+    touches only the current sub-window, so it is O(1); a query merges the live
+    sub-windows, which costs the same however many departures were seen. Expired
+    sub-windows are reused in place.
+    """
+    
+    MAX_DELAY_MINUTES = 30  # the last histogram bin holds this and anything later
+    PERCENTILES = (50, 90, 95)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+    
+    def configure(self, window=3600, subwindows=12, on_time_minutes=1, max_series=1000):
+        """A departure is on time when its delay is under on_time_minutes"""
+        with self.lock:
+            self.span = window / subwindows
+            self.subwindows = subwindows
+            self.on_time_minutes = on_time_minutes
+            self.max_series = max_series
+            self.series = {}
+            self.departures = {}  # train key -> departures already counted
+    
+    def count_departures(self, train_key, departures):
+        """How many of a train's departures are new since it was last seen (0 the first time);
+        a lower count than before means the schedule was rebuilt, so counting starts over"""
+        with self.lock:
+            last = self.departures.get(train_key)
+            self.departures[train_key] = departures
+        if last is None or departures <= last:
+            return 0
+        return departures - last
+    
+    def record(self, scopes, delay, count=1, at=None):
+        """Add count departures with the same delay (minutes) to every (scope, key) in scopes;
+        at is when they happened (default now), and ones already outside the window are dropped"""
+        current = int(time.time() // self.span)
+        window_index = current if at is None else int(at // self.span)
+        if window_index <= current - self.subwindows:
+            return
+        slot = window_index % self.subwindows
+        bins = self.MAX_DELAY_MINUTES + 1
+        delay_bin = min(max(int(round(delay)), 0), self.MAX_DELAY_MINUTES)
+        on_time = count if delay < self.on_time_minutes else 0
+        with self.lock:
+            for scope in scopes:
+                series = self.series.get(scope)
+                if series is None:
+                    if len(self.series) >= self.max_series:
+                        continue
+                    series = self.series[scope] = (
+                        array('q', [-1]) * self.subwindows, array('I', [0]) * self.subwindows,
+                        array('d', [0.0]) * self.subwindows, array('I', [0]) * self.subwindows,
+                        array('I', [0]) * (self.subwindows * bins))
+                windows, counts, sums, on_times, histogram = series
+                if windows[slot] > window_index:
+                    continue  # the slot already holds a newer sub-window
+                if windows[slot] != window_index:
+                    windows[slot] = window_index
+                    counts[slot] = sums[slot] = on_times[slot] = 0
+                    histogram[slot * bins:(slot + 1) * bins] = array('I', [0]) * bins
+                counts[slot] += count
+                sums[slot] += delay * count
+                on_times[slot] += on_time
+                histogram[slot * bins + delay_bin] += count
+    
+    def summary(self, scope, now=None):
+        """Departures, mean delay, delay percentiles and fraction on time over the window, or None"""
+        series = self.series.get(scope)
+        if series is None:
+            return None
+        current = int((time.time() if now is None else now) // self.span)
+        bins = self.MAX_DELAY_MINUTES + 1
+        windows, counts, sums, on_times, histogram = series
+        total = on_time = 0
+        delay_sum = 0.0
+        merged = [0] * bins
+        with self.lock:
+            for slot, window_index in enumerate(windows):
+                if current - window_index >= self.subwindows or window_index > current:
+                    continue
+                total += counts[slot]
+                delay_sum += sums[slot]
+                on_time += on_times[slot]
+                for delay_bin, hits in enumerate(histogram[slot * bins:(slot + 1) * bins]):
+                    merged[delay_bin] += hits
+        if not total:
+            return {'departures': 0}
+        stats = {'departures': total, 'meanDelay': round(delay_sum / total, 2), 'onTime': round(on_time / total, 3)}
+        for percentile in self.PERCENTILES:
+            target = percentile / 100 * total
+            seen = 0
+            for delay_bin, hits in enumerate(merged):
+                seen += hits
+                if seen >= target:
+                    stats[f"p{percentile}"] = delay_bin
+                    break
+        return stats
+    
+    def keys(self, scope_name=None):
+        """Sorted (scope, key) pairs tracked, optionally only those of one scope"""
+        with self.lock:
+            scopes = list(self.series)
+        return sorted(scope for scope in scopes if scope_name is None or scope[0] == scope_name)
+    
+    def __len__(self):
+        return len(self.series)
+
+
+class RankingEngine:
+    """Scores departure options and caches the ranking built from each data snapshot.
+    
+    An option's score is a cost in minutes: its wait and its delay, plus crowding,
+    weather and AQI at the destination, each a penalty in [0, 1] multiplied by a
+    weight saying how many minutes of waiting it is worth. Lowest scores rank first.
+    A ranking is reused for every request with the same key until its snapshot
+    changes, so it is computed once per snapshot rather than once per client.
+    """
+    
+    WEIGHTS = {'arrival': 1.0, 'delay': 1.0, 'crowding': 5.0, 'weather': 5.0, 'aqi': 5.0}
+    WEATHER_PENALTIES = {'Foggy': 0.3, 'Drizzle': 0.3, 'Rain': 0.7, 'Rain Showers': 0.7,
+                         'Snow': 1.0, 'Thunderstorm': 1.0}
+    COMFORTABLE_TEMPS = (5, 30)  # Celsius; outside this range adds to the weather penalty
+    WORST_AQI = 150  # 'Unhealthy for Sensitive' and above count as the full AQI penalty
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+    
+    def configure(self, weights=None, snapshot_seconds=10, max_rankings=1000):
+        with self.lock:
+            self.weights = dict(self.WEIGHTS)
+            self.weights.update(weights or {})
+            self.snapshot_seconds = snapshot_seconds
+            self.max_rankings = max_rankings
+            self.rankings = OrderedDict()  # key -> (snapshot, ranked options)
+    
+    def snapshot(self):
+        """The current time snapshot; rankings older than snapshot_seconds are rebuilt"""
+        return int(time.time() // self.snapshot_seconds)
+    
+    def weather_penalty(self, weather):
+        if not weather:
+            return 0.0
+        penalty = self.WEATHER_PENALTIES.get(weather.get('condition'), 0.0)
+        low, high = self.COMFORTABLE_TEMPS
+        if not low <= weather.get('temp', low) <= high:
+            penalty += 0.5
+        return min(penalty, 1.0)
+    
+    def score(self, option):
+        """Cost in minutes of an option with minutes, delay, crowding and weather keys"""
+        weights = self.weights
+        weather = option['weather']
+        aqi = (weather or {}).get('aqi') or 0
+        return round(weights['arrival'] * max(option['minutes'], 0)
+                     + weights['delay'] * option['delay']
+                     + weights['crowding'] * option['crowding']
+                     + weights['weather'] * self.weather_penalty(weather)
+                     + weights['aqi'] * min(aqi / self.WORST_AQI, 1.0), 2)
+    
+    def ranked(self, key, snapshot, build_options):
+        """Options for key, best first. build_options() returns them, each with a 'score'
+        from score(), and runs only when the snapshot has changed."""
+        with self.lock:
+            entry = self.rankings.get(key)
+            if entry is not None and entry[0] == snapshot:
+                self.rankings.move_to_end(key)
+                return entry[1]
+        ranking = sorted(build_options(), key=itemgetter('score'))
+        with self.lock:
+            self.rankings[key] = (snapshot, ranking)
+            self.rankings.move_to_end(key)
+            while len(self.rankings) > self.max_rankings:
+                self.rankings.popitem(last=False)
+        return ranking
+
+
+class TransitNetwork:
+    """Stations joined by lines, with the fastest trip between every pair precomputed.
+    
+    A hop between neighbouring stations takes the straight-line distance at an
+    average speed plus a dwell, and changing lines costs TRANSFER_MINUTES. The
+    constructor runs Dijkstra over (station, line) states from every station and
+    keeps the results in dense row-major matrices, so trip() is an O(1) lookup.
+    """
+    
+    SPEED_KMH = 55
+    DWELL_MINUTES = 0.5
+    TRANSFER_MINUTES = 5
+    
+    def __init__(self, coords, lines):
+        """coords is {code: (lat, lon)}; lines is {name: (hexcolor, frequency, ordered codes)}"""
+        self.lines = lines
+        self.neighbours = {}  # (station, line) -> [((station, line), minutes)]
+        self.lines_at = {}
+        for line, (hexcolor, frequency, stops) in lines.items():
+            for code in stops:
+                self.lines_at.setdefault(code, []).append(line)
+            for here, there in zip(stops, stops[1:]):
+                minutes = self.hop_minutes(coords[here], coords[there])
+                self.neighbours.setdefault((here, line), []).append(((there, line), minutes))
+                self.neighbours.setdefault((there, line), []).append(((here, line), minutes))
+        self.codes = sorted(self.lines_at)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        size = len(self.codes)
+        self.minutes = array('d', [math.inf]) * (size * size)
+        self.transfers = array('B', [0]) * (size * size)
+        self.legs = [()] * (size * size)
+        for code in self.codes:
+            self.search(code)
+    
+    @classmethod
+    def hop_minutes(cls, origin, destination):
+        lat1, lon1 = map(math.radians, origin)
+        lat2, lon2 = map(math.radians, destination)
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        km = 2 * 6371 * math.asin(math.sqrt(a))
+        return km / cls.SPEED_KMH * 60 + cls.DWELL_MINUTES
+    
+    def search(self, source):
+        """Fill the matrix row for source: fewest minutes, then fewest transfers, to every station"""
+        best = {}
+        previous = {}
+        heap = [((0.0, 0), (source, line)) for line in self.lines_at[source]]
+        for cost, state in heap:
+            best[state] = cost
+        while heap:
+            cost, state = heapq.heappop(heap)
+            if cost > best[state]:
+                continue
+            minutes, transfers = cost
+            station, line = state
+            moves = [(next_state, (minutes + hop, transfers)) for next_state, hop in self.neighbours.get(state, ())]
+            moves += [((station, other), (minutes + self.TRANSFER_MINUTES, transfers + 1))
+                      for other in self.lines_at[station] if other != line and station != source]
+            for next_state, next_cost in moves:
+                if next_cost < best.get(next_state, (math.inf, 0)):
+                    best[next_state] = next_cost
+                    previous[next_state] = state
+                    heapq.heappush(heap, (next_cost, next_state))
+        row = self.index[source] * len(self.codes)
+        arrivals = {}
+        for (station, line), cost in best.items():
+            if cost < arrivals.get(station, ((math.inf, 0), None))[0]:
+                arrivals[station] = (cost, (station, line))
+        for station, ((minutes, transfers), state) in arrivals.items():
+            cell = row + self.index[station]
+            self.minutes[cell] = minutes
+            self.transfers[cell] = transfers
+            self.legs[cell] = self.trace(state, previous, best)
+    
+    def trace(self, state, previous, best):
+        """The legs (line, board, alight, stops, minutes) of the path ending at state"""
+        path = [state]
+        while path[-1] in previous:
+            path.append(previous[path[-1]])
+        path.reverse()
+        legs = []
+        board = 0
+        for i in range(1, len(path) + 1):
+            if i < len(path) and path[i][1] == path[board][1]:
+                continue
+            # path[board:i] rides one line; a change of line starts the next leg at i
+            alight = i - 1
+            if path[alight][0] != path[board][0]:
+                legs.append((path[board][1], path[board][0], path[alight][0], alight - board,
+                             best[path[alight]][0] - best[path[board]][0]))
+            board = i
+        return tuple(legs)
+    
+    def trip(self, origin, destination):
+        """(minutes, transfers, legs) from origin to destination, or None if either is unknown or unreachable"""
+        if origin not in self.index or destination not in self.index:
+            return None
+        cell = self.index[origin] * len(self.codes) + self.index[destination]
+        if self.minutes[cell] == math.inf:
+            return None
+        return self.minutes[cell], self.transfers[cell], self.legs[cell]
+
+
+class StationIndex:
+    """The k stations nearest a point, by great-circle distance, from an implicit KD-tree.
+    
+    Stations become points on the unit sphere, where straight-line distance orders
+    the same way as distance along the surface, so one tree covers networks on any
+    continent. The points are stored in tree order (each range's median splits it
+    on the next axis), so there are no node objects and a query visits O(log n)
+    ranges plus whatever it cannot prune.
+    """
+    
+    EARTH_RADIUS_KM = 6371.0
+    
+    def __init__(self, stations):
+        """stations is an iterable of dicts with at least 'lat' and 'lon'"""
+        points = [(self.unit_vector(station['lat'], station['lon']), station) for station in stations]
+        self.order(points, 0, len(points), 0)
+        self.coords = array('d', [value for xyz, station in points for value in xyz])
+        self.stations = [station for xyz, station in points]
+    
+    @staticmethod
+    def unit_vector(lat, lon):
+        lat, lon = math.radians(lat), math.radians(lon)
+        return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+    
+    def order(self, points, lo, hi, axis):
+        if hi - lo <= 1:
+            return
+        points[lo:hi] = sorted(points[lo:hi], key=lambda point: point[0][axis])
+        mid = (lo + hi) // 2
+        self.order(points, lo, mid, (axis + 1) % 3)
+        self.order(points, mid + 1, hi, (axis + 1) % 3)
+    
+    def nearest(self, lat, lon, k=5):
+        """[(distance in km, station)] for the k nearest stations, closest first"""
+        if k <= 0 or not self.stations:
+            return []
+        target = self.unit_vector(lat, lon)
+        coords = self.coords
+        best = []  # max-heap of (-squared chord, index), at most k entries
+        pending = [(0, len(self.stations), 0, 0.0)]  # (lo, hi, axis, squared distance to its plane)
+        while pending:
+            lo, hi, axis, bound = pending.pop()
+            # The k-th best may have improved since a far side was queued; recheck before visiting it
+            if lo >= hi or (len(best) == k and bound >= -best[0][0]):
+                continue
+            mid = (lo + hi) // 2
+            base = mid * 3
+            dx, dy, dz = coords[base] - target[0], coords[base + 1] - target[1], coords[base + 2] - target[2]
+            squared = dx * dx + dy * dy + dz * dz
+            if len(best) < k:
+                heapq.heappush(best, (-squared, mid))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, mid))
+            offset = target[axis] - coords[base + axis]
+            near, far = ((lo, mid), (mid + 1, hi)) if offset < 0 else ((mid + 1, hi), (lo, mid))
+            next_axis = (axis + 1) % 3
+            # Only look across the splitting plane if it is closer than the k-th best so far
+            if len(best) < k or offset * offset < -best[0][0]:
+                pending.append((far[0], far[1], next_axis, offset * offset))
+            pending.append((near[0], near[1], next_axis, 0.0))
+        return [(2 * self.EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(-negative) / 2)), self.stations[index])
+                for negative, index in sorted(best, reverse=True)]
+    
+    def __len__(self):
+        return len(self.stations)
+
+
+class PrefixIndex:
+    """Ranked prefix search over names, using sorted arrays and bisect.
+    
+    Names are normalized (accents stripped, case folded, punctuation dropped) and
+    kept in two sorted lists: whole names, and every later word start, so 'oak'
+    finds '12th St. Oakland City Center' too. A query bisects to the first match
+    in each list and walks only as far as it needs: O(log n + limit). Whole-name
+    matches rank ahead of word matches.
+    """
+    
+    def __init__(self, entries):
+        """entries is a list of dicts with at least a 'name'"""
+        self.entries = entries
+        names = []
+        words = []
+        for position, entry in enumerate(entries):
+            normalized = self.normalize(entry['name'])
+            names.append((normalized, position))
+            tokens = normalized.split(' ')
+            words.extend((' '.join(tokens[start:]), position) for start in range(1, len(tokens)))
+        names.sort()
+        words.sort()
+        self.lists = [([key for key, position in pairs], array('I', [position for key, position in pairs]))
+                      for pairs in (names, words)]
+    
+    @staticmethod
+    def normalize(text):
+        """'São Paulo' -> 'sao paulo', "King's Cross St. Pancras" -> 'kings cross st pancras'"""
+        decomposed = unicodedata.normalize('NFKD', text)
+        folded = ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+        folded = folded.replace("'", '').replace('’', '')
+        return ' '.join(''.join(ch if ch.isalnum() else ' ' for ch in folded).split())
+    
+    def search(self, text, limit=10):
+        """Up to limit entries whose name, or a word in it, starts with text"""
+        prefix = self.normalize(text)
+        if not prefix:
+            return []
+        found = []
+        seen = set()
+        for keys, positions in self.lists:
+            i = bisect_left(keys, prefix)
+            while i < len(keys) and len(found) < limit and keys[i].startswith(prefix):
+                if positions[i] not in seen:
+                    seen.add(positions[i])
+                    found.append(self.entries[positions[i]])
+                i += 1
+        return found
+    
+    def exact(self, text):
+        """Entries whose whole name normalizes to the same string as text"""
+        key = self.normalize(text)
+        keys, positions = self.lists[0]
+        i = bisect_left(keys, key)
+        found = []
+        while i < len(keys) and keys[i] == key:
+            found.append(self.entries[positions[i]])
+            i += 1
+        return found
+    
+    def suggest(self, text, limit=5):
+        """Matches for the longest leading part of text that has any, e.g. for a misspelling"""
+        prefix = self.normalize(text)
+        for length in range(len(prefix), 0, -1):
+            found = self.search(prefix[:length], limit)
+            if found:
+                return found
+        return []
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class MessagePackCodec:
+    """MessagePack with a string table, for clients that find JSON too big to parse.
+    
+    A document is sent as the two-element array [strings, value]. Every string that
+    occurs more than once in value (keys included) is stored once in strings, and
+    each use is an ext value of type STRING_REF holding its big-endian index, three
+    bytes rather than the whole string. Standard MessagePack decoders read the
+    format; decode() here shows how to resolve the references.
+    """
+    
+    CONTENT_TYPE = 'application/msgpack'
+    ACCEPTED = ('application/msgpack', 'application/x-msgpack')
+    STRING_REF = 1
+    MIN_SHARED_LENGTH = 3  # shorter strings cost no more inline than as a reference
+    # kind -> (fix marker, largest fix size + 1, 16-bit marker, 32-bit marker)
+    HEADERS = {'str': (0xa0, 32, 0xda, 0xdb), 'array': (0x90, 16, 0xdc, 0xdd), 'map': (0x80, 16, 0xde, 0xdf)}
+    
+    @classmethod
+    def accepts(cls, accept_header):
+        """Whether an Accept header asks for this format"""
+        return any(part.split(';')[0].strip().lower() in cls.ACCEPTED for part in (accept_header or '').split(','))
+    
+    @classmethod
+    def encode(cls, value):
+        counts = {}
+        cls.count_strings(value, counts)
+        shared = sorted((text for text, count in counts.items() if count > 1 and len(text) >= cls.MIN_SHARED_LENGTH),
+                        key=lambda text: -counts[text])
+        # Packed bytes per string: references for shared ones, filled in lazily for the rest
+        table = {text: cls.pack_ref(index) for index, text in enumerate(shared)}
+        out = bytearray(b'\x92')
+        cls.packer(out, {})(shared)
+        cls.packer(out, table)(value)
+        return bytes(out)
+    
+    @classmethod
+    def pack_ref(cls, index):
+        if index < 0x100:
+            return struct.pack('>BbB', 0xd4, cls.STRING_REF, index)
+        if index < 0x10000:
+            return struct.pack('>BbH', 0xd5, cls.STRING_REF, index)
+        return struct.pack('>BbI', 0xd6, cls.STRING_REF, index)
+    
+    @staticmethod
+    def count_strings(value, counts):
+        """Add every string in value, dict keys included, to counts"""
+        get = counts.get
+        
+        def count(value):
+            kind = type(value)
+            if kind is str:
+                counts[value] = get(value, 0) + 1
+            elif kind is dict:
+                for key, item in value.items():
+                    counts[key] = get(key, 0) + 1
+                    count(item)
+            elif kind is list or kind is tuple:
+                for item in value:
+                    count(item)
+        
+        count(value)
+    
+    @classmethod
+    def packer(cls, out, table):
+        """A function appending a value's encoding to out. Dispatch is on the exact type,
+        commonest first, and strings are encoded once each through table."""
+        append, extend = out.append, out.extend
+        pack_header, pack_int = cls.pack_header, cls.pack_int
+        pack_float = struct.Struct('>Bd').pack
+        
+        def pack(value):
+            kind = type(value)
+            if kind is str:
+                packed = table.get(value)
+                if packed is None:
+                    encoded = value.encode('utf-8')
+                    packed = bytearray()
+                    pack_header(len(encoded), packed, 'str')
+                    packed += encoded
+                    table[value] = packed
+                extend(packed)
+            elif kind is dict:
+                if len(value) < 16:
+                    append(0x80 | len(value))
+                else:
+                    pack_header(len(value), out, 'map')
+                for key, item in value.items():
+                    pack(key)
+                    pack(item)
+            elif kind is list or kind is tuple:
+                if len(value) < 16:
+                    append(0x90 | len(value))
+                else:
+                    pack_header(len(value), out, 'array')
+                for item in value:
+                    pack(item)
+            elif kind is int:
+                if 0 <= value < 0x80:
+                    append(value)
+                else:
+                    pack_int(value, out)
+            elif kind is float:
+                extend(pack_float(0xcb, value))
+            elif value is None:
+                append(0xc0)
+            elif value is True:
+                append(0xc3)
+            elif value is False:
+                append(0xc2)
+            else:
+                # Subclasses (IntEnum and the like) encode as their base type
+                for base in (str, int, float, dict, list, tuple):
+                    if isinstance(value, base):
+                        pack(base(value))
+                        return
+                raise TypeError(f"cannot encode {type(value).__name__}")
+        
+        return pack
+    
+    @staticmethod
+    def pack_int(value, out):
+        if 0 <= value < 0x80 or -32 <= value < 0:
+            out += struct.pack('>b' if value < 0 else '>B', value)
+        elif value >= 0:
+            for marker, fmt, limit in ((0xcc, '>BB', 1 << 8), (0xcd, '>BH', 1 << 16), (0xce, '>BI', 1 << 32),
+                                       (0xcf, '>BQ', 1 << 64)):
+                if value < limit:
+                    out += struct.pack(fmt, marker, value)
+                    return
+            raise OverflowError('integer too large for MessagePack')
+        else:
+            for marker, fmt, limit in ((0xd0, '>Bb', 1 << 7), (0xd1, '>Bh', 1 << 15), (0xd2, '>Bi', 1 << 31),
+                                       (0xd3, '>Bq', 1 << 63)):
+                if value >= -limit:
+                    out += struct.pack(fmt, marker, value)
+                    return
+            raise OverflowError('integer too large for MessagePack')
+    
+    @classmethod
+    def pack_header(cls, size, out, kind):
+        """Length header for a 'str', 'array' or 'map' of size bytes or items"""
+        fix_marker, fix_limit, marker16, marker32 = cls.HEADERS[kind]
+        if size < fix_limit:
+            out.append(fix_marker | size)
+        elif kind == 'str' and size < 0x100:
+            out += struct.pack('>BB', 0xd9, size)
+        elif size < 0x10000:
+            out += struct.pack('>BH', marker16, size)
+        else:
+            out += struct.pack('>BI', marker32, size)
+    
+    @classmethod
+    def decode(cls, data):
+        """The document encode() was given, with string references resolved"""
+        strings, offset = cls.unpack(data, 1, ())
+        value, offset = cls.unpack(data, offset, strings)
+        return value
+    
+    @classmethod
+    def unpack(cls, data, offset, strings):
+        marker = data[offset]
+        offset += 1
+        if marker < 0x80:
+            return marker, offset
+        if marker >= 0xe0:
+            return marker - 0x100, offset
+        if 0xa0 <= marker < 0xc0 or marker in (0xd9, 0xda, 0xdb):
+            if marker < 0xc0:
+                size = marker & 0x1f
+            else:
+                fmt = {0xd9: '>B', 0xda: '>H', 0xdb: '>I'}[marker]
+                size = struct.unpack_from(fmt, data, offset)[0]
+                offset += struct.calcsize(fmt)
+            return data[offset:offset + size].decode('utf-8'), offset + size
+        if 0x80 <= marker < 0xa0 or marker in (0xdc, 0xdd, 0xde, 0xdf):
+            is_map = marker < 0x90 or marker in (0xde, 0xdf)
+            if marker < 0xa0:
+                size = marker & 0x0f
+            else:
+                fmt = '>H' if marker in (0xdc, 0xde) else '>I'
+                size = struct.unpack_from(fmt, data, offset)[0]
+                offset += struct.calcsize(fmt)
+            items = []
+            for _ in range(size * 2 if is_map else size):
+                item, offset = cls.unpack(data, offset, strings)
+                items.append(item)
+            return (dict(zip(items[::2], items[1::2])) if is_map else items), offset
+        if marker in (0xd4, 0xd5, 0xd6):
+            fmt = {0xd4: '>bB', 0xd5: '>bH', 0xd6: '>bI'}[marker]
+            ext_type, index = struct.unpack_from(fmt, data, offset)
+            if ext_type != cls.STRING_REF:
+                raise ValueError(f"unknown ext type {ext_type}")
+            return strings[index], offset + struct.calcsize(fmt)
+        simple = {0xc0: None, 0xc2: False, 0xc3: True}
+        if marker in simple:
+            return simple[marker], offset
+        fmt = {0xca: '>f', 0xcb: '>d', 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+               0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q'}.get(marker)
+        if fmt is None:
+            raise ValueError(f"unsupported MessagePack marker 0x{marker:02x}")
+        return struct.unpack_from(fmt, data, offset)[0], offset + struct.calcsize(fmt)
+
+
+def traced(name):
+    """Run the decorated function inside a span of the handler's tracer"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with BARTProxyHandler.tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 
 class BARTProxyHandler(SimpleHTTPRequestHandler):
     
     # Class variable to store train schedules and weather cache
     train_schedules = {}
     schedule_created_at = None
+    # Seed of the current schedule epoch; each station's trains derive from it
+    schedule_epoch_seed = None
     weather_cache = {}
     weather_cache_time = {}
+    # Pre-encoded JSON for each weather_cache entry, stored alongside it
+    weather_cache_json = {}
+    # Weather entries live for 10 minutes
+    WEATHER_CACHE_TTL = 600
+    # SharedWeatherCache used by pre-forked workers; None keeps the cache per process
+    shared_weather = None
+    # Forecasts and TfL line status: namespace -> {key: (fetched_at epoch, payload)}
+    response_cache = {}
+    FORECAST_CACHE_TTL = 1800
+    LINE_STATUS_CACHE_TTL = 60
+    # On-disk copy of the caches above for warm restarts; idle unless run_server is given a file
+    persistent_cache = PersistentCache()
+    # Pre-encoded JSON for stable response pieces (station headers, destination and estimate bodies)
+    json_fragments = {}
+    # Last raw TfL arrivals per known station: station_id -> (fetched at, arrivals), served
+    # (aged) when the tfl budget is spent
+    tfl_arrivals = {}
+    
+    # Routes that get their own request metrics; everything else is 'static'
+    API_ROUTES = ('/api/bart', '/api/tfl', '/api/tfl-status', '/api/weather', '/api/batch', '/api/history',
+                  '/api/reliability', '/api/route', '/api/nearest', '/api/autocomplete', '/api/reset', '/metrics',
+                  '/debug/traces')
+    TRACED_ROUTES = ('/api/bart', '/api/tfl', '/api/tfl-status', '/api/weather', '/api/batch', '/api/reset')
+    
+    # Endpoint classes for rate limiting: 'upstream' routes can trigger live API calls,
+    # 'simulated' ones are computed locally; anything unlisted is never limited
+    RATE_LIMIT_CLASSES = {
+        '/api/tfl': 'upstream',
+        '/api/tfl-status': 'upstream',
+        '/api/weather': 'upstream',
+        '/api/bart': 'simulated',
+        '/api/history': 'simulated',
+        '/api/reliability': 'simulated',
+        '/api/route': 'simulated',
+        '/api/nearest': 'simulated',
+        '/api/autocomplete': 'simulated',
+        '/api/reset': 'admin'
+    }
+    # Idle unless run_server is given rate limits
+    rate_limiter = RateLimiter()
+    
+    # Admission control (see AdmissionController): these routes queue behind cheap ones,
+    # and the exempt ones are never queued or shed so monitoring keeps working
+    UPSTREAM_ROUTES = ('/api/tfl', '/api/tfl-status', '/api/weather', '/api/batch')
+    ADMISSION_EXEMPT = ('/metrics', '/debug/traces')
+    # Idle unless run_server is given a maximum number of active requests
+    admission = AdmissionController()
+    
+    # Calls per upstream API; counted always, enforced only for configured limits
+    budget = UpstreamBudget()
+    
+    # Arrival, delay, line severity and weather samples over time (see TimeSeriesHistory)
+    history = TimeSeriesHistory()
+    # Rolling on-time statistics for simulated BART departures (see ReliabilityStats)
+    reliability = ReliabilityStats()
+    RELIABILITY_SCOPES = ('line', 'destination', 'station')
+    # Ranks options for rank= on /api/bart and /api/tfl (see RankingEngine)
+    ranking = RankingEngine()
+    
+    # Persistent connections: a connection closes once it has sat idle for `timeout`
+    # seconds (StreamRequestHandler applies it to the socket) or has answered
+    # max_keepalive_requests; run_server sets both from --keepalive-*
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes; with Nagle on, the body would wait
+    # for the client's delayed ACK (~40 ms) on every reused connection
+    disable_nagle_algorithm = True
+    timeout = 15
+    max_keepalive_requests = 100
+    # Nothing here takes a request body; larger ones are refused rather than read
+    MAX_REQUEST_BODY = 64 * 1024
+    requests_on_connection = 0
+    
+    # Routes that answer in MessagePack (see MessagePackCodec) when Accept asks for it;
+    # do_GET sets these per request
+    BINARY_ROUTES = ('/api/bart', '/api/tfl', '/api/tfl-status')
+    negotiable = False
+    binary = False
+    
+    # Per-destination keys that fields= can select, in response order
+    BART_FIELDS = ('destination', 'abbreviation', 'limited', 'estimate', 'weather')
+    TFL_FIELDS = ('destination', 'line', 'color', 'weather', 'estimates')
+    
+    # Routes /api/batch can run, and the handler method for each
+    BATCH_HANDLERS = {
+        '/api/bart': 'handle_bart_api',
+        '/api/tfl': 'handle_tfl_api',
+        '/api/tfl-status': 'handle_tfl_status',
+        '/api/weather': 'handle_weather_api',
+        '/api/history': 'handle_history',
+        '/api/reliability': 'handle_reliability',
+        '/api/route': 'handle_route',
+        '/api/nearest': 'handle_nearest',
+        '/api/autocomplete': 'handle_autocomplete'
+    }
+    BATCH_MAX_QUERIES = 20
+    BATCH_CONCURRENCY = 8
+    # Threads one batch may hold at once, so a single batch can't occupy the whole pool
+    BATCH_PER_REQUEST = 3
+    # Created on first use, so each pre-forked worker gets its own threads
+    batch_executor = None
+    batch_executor_lock = threading.Lock()
+    
+    metrics = MetricsRegistry()
+    metrics.describe('http_requests_total', 'counter', 'HTTP requests served, by route and status')
+    metrics.describe('http_request_duration_seconds', 'histogram', 'HTTP request latency, by route')
+    metrics.describe('upstream_requests_total', 'counter', 'Upstream API calls, by host')
+    metrics.describe('upstream_errors_total', 'counter', 'Failed upstream API calls, by host')
+    metrics.describe('upstream_request_duration_seconds', 'histogram', 'Upstream API call latency, by host')
+    metrics.describe('weather_cache_hits_total', 'counter', 'Weather cache lookups served from cache')
+    metrics.describe('weather_cache_misses_total', 'counter', 'Weather cache lookups that went upstream')
+    metrics.describe('weather_cache_entries', 'gauge', 'Entries currently held in the weather cache')
+    metrics.gauge('weather_cache_entries', lambda: len(BARTProxyHandler.weather_cache))
+    metrics.describe('weather_cache_shared_hits_total', 'counter',
+                     'Weather cache hits on an entry another worker fetched')
+    metrics.describe('rate_limited_total', 'counter', 'Requests rejected with 429, by endpoint class')
+    metrics.describe('rate_limit_buckets', 'gauge', 'Token buckets currently tracked')
+    metrics.gauge('rate_limit_buckets', lambda: len(BARTProxyHandler.rate_limiter))
+    metrics.describe('admission_rejected_total', 'counter', 'Requests shed with 503, by priority and reason')
+    metrics.describe('admission_active', 'gauge', 'Requests currently admitted')
+    metrics.gauge('admission_active', lambda: BARTProxyHandler.admission.running())
+    metrics.describe('admission_queued', 'gauge', 'Requests waiting for admission')
+    metrics.gauge('admission_queued', lambda: BARTProxyHandler.admission.queued())
+    metrics.describe('upstream_budget_calls', 'gauge', 'Upstream calls in the current minute and day, by upstream')
+    metrics.gauge('upstream_budget_calls', lambda: BARTProxyHandler.budget.snapshot())
+    metrics.describe('upstream_budget_denied_total', 'counter', 'Upstream calls skipped to stay within budget')
+    metrics.describe('history_series', 'gauge', 'Time series held by the history store')
+    metrics.gauge('history_series', lambda: len(BARTProxyHandler.history))
+    metrics.describe('batch_queries_total', 'counter', 'Sub-queries run by /api/batch, by route and status')
+    
+    # Disabled until run_server is given a sample rate
+    tracer = Tracer()
+    
+    logger = StructuredLogger()
+    
+    # Upstream capture/replay (see UpstreamTape); idle unless run_server enables it
+    tape = UpstreamTape()
+    
+    # Seed for the simulated schedules; None keeps them random on every start
+    schedule_seed = None
+    # Schedule creation time (epoch seconds) shared by pre-forked workers; None when single-process
+    shared_schedule_epoch = None
+    # /api/reset calls so far, shared by pre-forked workers so each drops its own caches
+    shared_reset_count = None
+    reset_seen = 0
+    metrics.describe('log_records_dropped', 'gauge', 'Log records dropped because the writer fell behind')
+    metrics.gauge('log_records_dropped', lambda: BARTProxyHandler.logger.dropped)
+    
+    # Upstream APIs are called with certificate checks disabled (see fetch_json)
+    UPSTREAM_SSL_CONTEXT = ssl._create_unverified_context()
     
     # BART Station Coordinates (latitude, longitude)
     STATION_COORDS = {
@@ -131,6 +1961,11 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
     # Just need proper User-Agent headers
     TFL_BASE_URL = 'https://api.tfl.gov.uk'
     
+    # Open-Meteo endpoints; run_server can point these (and TFL_BASE_URL) at local stand-ins
+    OPEN_METEO_URL = 'https://api.open-meteo.com/v1/forecast'
+    AIR_QUALITY_URL = 'https://air-quality-api.open-meteo.com/v1/air-quality'
+    TFL_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+    
     # Station data
     STATIONS = {
         '12TH': '12th St. Oakland City Center',
@@ -223,21 +2058,97 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
         ]
     }
     
+    # BART lines: (hexcolor, minutes between trains, stations in order)
+    BART_LINES = {
+        'YELLOW': ('ffff33', 15, ('PITT', 'NCON', 'CONC', 'PHIL', 'WCRK', 'LAFY', 'ORIN', 'ROCK', 'MCAR', '19TH',
+                                  '12TH', 'WOAK', 'EMBR', 'MONT', 'POWL', 'CIVC', '16TH', '24TH', 'GLEN', 'BALB',
+                                  'DALY', 'COLM', 'SSAN', 'SBRN', 'SFIA', 'MLBR')),
+        'ORANGE': ('ff9933', 15, ('RICH', 'DELN', 'PLZA', 'NBRK', 'DBRK', 'ASHB', 'MCAR', '19TH', '12TH', 'LAKE',
+                                  'FTVL', 'COLS', 'SANL', 'BAYF', 'HAYW', 'SHAY', 'UCTY', 'FRMT', 'WARM')),
+        'RED': ('ff0000', 15, ('RICH', 'DELN', 'PLZA', 'NBRK', 'DBRK', 'ASHB', 'MCAR', '19TH', '12TH', 'WOAK',
+                               'EMBR', 'MONT', 'POWL', 'CIVC', '16TH', '24TH', 'GLEN', 'BALB', 'DALY', 'COLM',
+                               'SSAN', 'SBRN', 'MLBR')),
+        'GREEN': ('339933', 15, ('WARM', 'FRMT', 'UCTY', 'SHAY', 'HAYW', 'BAYF', 'SANL', 'COLS', 'FTVL', 'LAKE',
+                                 'WOAK', 'EMBR', 'MONT', 'POWL', 'CIVC', '16TH', '24TH', 'GLEN', 'BALB', 'DALY')),
+        'BLUE': ('0099cc', 15, ('DUBL', 'WDUB', 'CAST', 'BAYF', 'SANL', 'COLS', 'FTVL', 'LAKE', 'WOAK', 'EMBR',
+                                'MONT', 'POWL', 'CIVC', '16TH', '24TH', 'GLEN', 'BALB', 'DALY')),
+        'BEIGE': ('d5cfa3', 6, ('COLS', 'OAKL'))
+    }
+    # TransitNetwork over BART_LINES; built by run_server, or on first use
+    network = None
+    network_lock = threading.Lock()
+    # StationIndex per network ('bart', 'tfl', ...) plus 'all', for /api/nearest; built by
+    # run_server or on first use, from the tables here and stations_file if set
+    station_indexes = None
+    station_indexes_lock = threading.Lock()
+    stations_file = None
+    NEAREST_MAX_K = 50
+    # PrefixIndex over station and city names ('all', 'station', 'city') for /api/autocomplete
+    name_indexes = None
+    name_indexes_lock = threading.Lock()
+    AUTOCOMPLETE_MAX = 50
+    
+    @classmethod
+    def fetch_json(cls, url, timeout=10, headers=None):
+        """Fetch and decode a JSON document from an upstream API, recording metrics per host"""
+        host = urlparse(url).hostname or 'unknown'
+        labels = (('host', host),)
+        request = urllib.request.Request(url)
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+        
+        upstream = cls.upstream_name(url)
+        if not cls.tape.replaying and not cls.budget.acquire(upstream):
+            priority = cls.budget.priority()
+            cls.metrics.inc('upstream_budget_denied_total', (('upstream', upstream), ('priority', priority)))
+            raise BudgetExhausted(f"{upstream} call budget spent for {priority} requests")
+        
+        started = time.perf_counter()
+        with cls.tracer.span('upstream', host=host):
+            try:
+                if cls.tape.replaying:
+                    return cls.tape.replay(url)
+                with urllib.request.urlopen(request, context=cls.UPSTREAM_SSL_CONTEXT, timeout=timeout) as response:
+                    data = json.loads(response.read().decode())
+                if cls.tape.recording:
+                    cls.tape.record(url, time.perf_counter() - started, body=data)
+                return data
+            except Exception as e:
+                cls.metrics.inc('upstream_errors_total', labels)
+                if cls.tape.recording:
+                    cls.tape.record(url, time.perf_counter() - started, error=str(e))
+                raise
+            finally:
+                cls.metrics.inc('upstream_requests_total', labels)
+                cls.metrics.observe('upstream_request_duration_seconds', labels, time.perf_counter() - started)
+    
+    @classmethod
+    def upstream_name(cls, url):
+        """Which budget a URL draws on: the forecast and air-quality APIs share Open-Meteo's"""
+        if url.startswith((cls.OPEN_METEO_URL, cls.AIR_QUALITY_URL)):
+            return 'open-meteo'
+        return 'tfl'
+    
     @classmethod
+    @traced('get_weather_forecast')
     def get_weather_forecast(cls, city_name, days=7):
         """Fetch weather forecast from Open-Meteo API"""
+        # Only known cities are cached, so arbitrary query strings can't grow the cache
+        cacheable = city_name in cls.CITY_COORDS and 1 <= days <= 16
+        cache_key = f"{city_name}|{days}"
+        if cacheable:
+            cached = cls.cached_response('forecast', cache_key, cls.FORECAST_CACHE_TTL)
+            if cached is not None:
+                return cached
+        
         try:
             # Get coordinates for the city
             lat, lon = cls.CITY_COORDS.get(city_name, (37.7749, -122.4194))
             
             # Open-Meteo Forecast API
-            forecast_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&daily=temperature_2m_max,temperature_2m_min,weather_code,precipitation_probability_max,wind_speed_10m_max&temperature_unit=celsius&wind_speed_unit=kmh&forecast_days={days}"
-            
-            ssl_context = ssl._create_unverified_context()
-            request = urllib.request.Request(forecast_url)
+            forecast_url = f"{cls.OPEN_METEO_URL}?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&daily=temperature_2m_max,temperature_2m_min,weather_code,precipitation_probability_max,wind_speed_10m_max&temperature_unit=celsius&wind_speed_unit=kmh&forecast_days={days}"
             
-            with urllib.request.urlopen(request, context=ssl_context, timeout=10) as response:
-                data = json.loads(response.read().decode())
+            data = cls.fetch_json(forecast_url, timeout=10)
             
             current = data.get('current', {})
             daily = data.get('daily', {})
@@ -279,18 +2190,20 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
                     'windSpeed': round(wind_speeds[i], 1) if i < len(wind_speeds) else 10
                 })
             
-            print(f"   🌤️  Forecast for {city_name}: {current_weather['temp']}°C, {current_weather['condition']}")
+            cls.logger.info('forecast.fetched', sampled=True, city=city_name,
+                            temp=current_weather['temp'], condition=current_weather['condition'])
             
-            return {
+            forecast_data = {
                 'city': city_name,
                 'current': current_weather,
                 'forecast': forecast
             }
+            if cacheable:
+                cls.store_response('forecast', cache_key, forecast_data)
+            return forecast_data
             
         except Exception as e:
-            print(f"   ⚠️  Forecast API error: {e}")
-            import traceback
-            traceback.print_exc()
+            cls.logger.exception('forecast.error', city=city_name, error=str(e))
             return cls.get_fallback_forecast(city_name, days)
     
     @classmethod
@@ -322,14 +2235,110 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
         }
     
     @classmethod
+    def cached_weather(cls, cache_key):
+        """Weather for cache_key if fetched within WEATHER_CACHE_TTL (stretched while the Open-Meteo
+        budget is low), counting the hit or miss"""
+        ttl = cls.WEATHER_CACHE_TTL * cls.budget.ttl_factor('open-meteo')
+        if cls.shared_weather is not None:
+            entry = cls.shared_weather.get(cache_key, ttl)
+            if entry is not None:
+                weather_data, encoded, stored_at, decoded_here = entry
+                if decoded_here:
+                    # Fetched by another worker; mirror it locally for encoded_weather
+                    cls.weather_cache[cache_key] = weather_data
+                    cls.weather_cache_json[cache_key] = encoded
+                    cls.weather_cache_time[cache_key] = datetime.fromtimestamp(stored_at)
+                    cls.metrics.inc('weather_cache_shared_hits_total')
+                cls.metrics.inc('weather_cache_hits_total')
+                return weather_data
+        elif cache_key in cls.weather_cache:
+            cache_age = (datetime.now() - cls.weather_cache_time[cache_key]).total_seconds()
+            if cache_age < ttl:
+                cls.metrics.inc('weather_cache_hits_total')
+                return cls.weather_cache[cache_key]
+        cls.metrics.inc('weather_cache_misses_total')
+        return None
+    
+    @classmethod
+    def store_weather(cls, cache_key, weather_data):
+        """Cache a fetched weather dict with its JSON encoding, in every worker when shared"""
+        stored_at = datetime.now()
+        encoded = json.dumps(weather_data).encode()
+        cls.weather_cache[cache_key] = weather_data
+        cls.weather_cache_json[cache_key] = encoded
+        cls.weather_cache_time[cache_key] = stored_at
+        if cls.shared_weather is not None:
+            cls.shared_weather.put(cache_key, weather_data, encoded, stored_at.timestamp())
+        cls.persist('weather', cache_key, encoded.decode(), stored_at.timestamp())
+        cls.history.record('temperature', cache_key, weather_data.get('temp'))
+        cls.history.record('aqi', cache_key, weather_data.get('aqi'))
+    
+    @classmethod
+    def warm_weather(cls):
+        """Fetch weather for every BART destination not already cached, as background work"""
+        codes = sorted({dest[1] for code in cls.STATIONS for dest in cls.station_destinations(code)})
+        with cls.budget.background():
+            for code in codes:
+                cls.get_weather_data(code)  # a cache hit when already fresh
+        cls.logger.info('weather.warmed', destinations=len(codes))
+    
+    @classmethod
+    def cached_response(cls, namespace, key, ttl):
+        """A payload from response_cache if stored less than ttl seconds ago (stretched while the
+        upstream's budget is low), else None"""
+        upstream = 'tfl' if namespace == 'line_status' else 'open-meteo'
+        entry = cls.response_cache.get(namespace, {}).get(key)
+        if entry is not None and time.time() - entry[0] < ttl * cls.budget.ttl_factor(upstream):
+            return entry[1]
+        return None
+    
+    @classmethod
+    def store_response(cls, namespace, key, payload):
+        stored_at = time.time()
+        cls.response_cache.setdefault(namespace, {})[key] = (stored_at, payload)
+        cls.persist(namespace, key, json.dumps(payload), stored_at)
+    
+    @classmethod
+    def persist(cls, namespace, key, value, stored_at):
+        """Write an entry through to the persistent cache, if one is configured"""
+        if not cls.persistent_cache.enabled:
+            return
+        try:
+            cls.persistent_cache.put(namespace, key, value, stored_at)
+        except sqlite3.Error as e:
+            cls.logger.warning('cache.persist_error', namespace=namespace, key=key, error=str(e))
+    
+    @classmethod
+    def load_persistent_cache(cls):
+        """Warm the in-memory caches with persisted entries that are still within their TTL"""
+        cache = cls.persistent_cache
+        weather = cache.load('weather', cls.WEATHER_CACHE_TTL)
+        for key, (value, stored_at) in weather.items():
+            weather_data = json.loads(value)
+            cls.weather_cache[key] = weather_data
+            cls.weather_cache_json[key] = value.encode()
+            cls.weather_cache_time[key] = datetime.fromtimestamp(stored_at)
+            if cls.shared_weather is not None:
+                cls.shared_weather.put(key, weather_data, value.encode(), stored_at)
+        loaded = {'weather': len(weather)}
+        for namespace, ttl in (('forecast', cls.FORECAST_CACHE_TTL), ('line_status', cls.LINE_STATUS_CACHE_TTL)):
+            entries = cache.load(namespace, ttl)
+            cls.response_cache[namespace] = {key: (stored_at, json.loads(value))
+                                             for key, (value, stored_at) in entries.items()}
+            loaded[namespace] = len(entries)
+        # Reopened lazily by whichever process writes next (workers are forked after this)
+        cache.close()
+        cls.logger.info('cache.loaded', **loaded)
+    
+    @classmethod
+    @traced('get_weather_data')
     def get_weather_data(cls, station_code):
         """Fetch real weather data from Open-Meteo API"""
         # Check cache (cache for 10 minutes)
         cache_key = station_code
-        if cache_key in cls.weather_cache:
-            cache_age = (datetime.now() - cls.weather_cache_time[cache_key]).total_seconds()
-            if cache_age < 600:  # 10 minutes
-                return cls.weather_cache[cache_key]
+        cached = cls.cached_weather(cache_key)
+        if cached is not None:
+            return cached
         
         try:
             # Get coordinates for this station
@@ -339,13 +2348,9 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
             lat, lon = cls.STATION_COORDS[station_code]
             
             # Open-Meteo API (free, no key needed)
-            weather_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&temperature_unit=celsius&wind_speed_unit=kmh"
+            weather_url = f"{cls.OPEN_METEO_URL}?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&temperature_unit=celsius&wind_speed_unit=kmh"
             
-            ssl_context = ssl._create_unverified_context()
-            request = urllib.request.Request(weather_url)
-            
-            with urllib.request.urlopen(request, context=ssl_context, timeout=5) as response:
-                data = json.loads(response.read().decode())
+            data = cls.fetch_json(weather_url, timeout=5)
             
             current = data.get('current', {})
             
@@ -368,30 +2373,27 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
             weather_data.update(aqi_data)
             
             # Cache the result
-            cls.weather_cache[cache_key] = weather_data
-            cls.weather_cache_time[cache_key] = datetime.now()
+            cls.store_weather(cache_key, weather_data)
             
-            print(f"   🌤️  Weather for {cls.STATIONS.get(station_code)}: {weather_data['temp']}°C, {weather_data['condition']}")
+            cls.logger.info('weather.fetched', sampled=True, location=cls.STATIONS.get(station_code),
+                            temp=weather_data['temp'], condition=weather_data['condition'])
             
             return weather_data
             
         except Exception as e:
-            print(f"   ⚠️  Weather API error: {e}")
+            cls.logger.warning('weather.error', location=station_code, error=str(e))
             # Return fallback data
             return cls.get_fallback_weather()
     
     @classmethod
+    @traced('get_real_aqi')
     def get_real_aqi(cls, lat, lon):
         """Fetch real AQI data from Open-Meteo Air Quality API"""
         try:
             # Open-Meteo Air Quality API - provides US AQI and pollutant data
-            aqi_url = f"https://air-quality-api.open-meteo.com/v1/air-quality?latitude={lat}&longitude={lon}&current=us_aqi,pm10,pm2_5"
-            
-            ssl_context = ssl._create_unverified_context()
-            request = urllib.request.Request(aqi_url)
+            aqi_url = f"{cls.AIR_QUALITY_URL}?latitude={lat}&longitude={lon}&current=us_aqi,pm10,pm2_5"
             
-            with urllib.request.urlopen(request, context=ssl_context, timeout=5) as response:
-                data = json.loads(response.read().decode())
+            data = cls.fetch_json(aqi_url, timeout=5)
             
             current = data.get('current', {})
             
@@ -400,18 +2402,7 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
             
             # If US AQI is not available, calculate from PM2.5
             if aqi_value is None or aqi_value == 0:
-                pm25 = current.get('pm2_5', 10)
-                # Convert PM2.5 to AQI using EPA formula (simplified)
-                if pm25 <= 12.0:
-                    aqi_value = int((50 / 12.0) * pm25)
-                elif pm25 <= 35.4:
-                    aqi_value = int(50 + ((100 - 50) / (35.4 - 12.1)) * (pm25 - 12.1))
-                elif pm25 <= 55.4:
-                    aqi_value = int(100 + ((150 - 100) / (55.4 - 35.5)) * (pm25 - 35.5))
-                elif pm25 <= 150.4:
-                    aqi_value = int(150 + ((200 - 150) / (150.4 - 55.5)) * (pm25 - 55.5))
-                else:
-                    aqi_value = int(200 + ((300 - 200) / (250.4 - 150.5)) * (pm25 - 150.5))
+                aqi_value = cls.pm25_to_aqi(current.get('pm2_5', 10))
             else:
                 aqi_value = int(aqi_value)
             
@@ -421,7 +2412,7 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
             # Map AQI to level, color, and icon
             aqi_level, aqi_color, aqi_icon = cls.map_aqi(aqi_value)
             
-            print(f"   🌫️  Real AQI: {aqi_value} ({aqi_level})")
+            cls.logger.info('aqi.fetched', sampled=True, aqi=aqi_value, level=aqi_level)
             
             return {
                 'aqi': aqi_value,
@@ -431,7 +2422,7 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
             }
             
         except Exception as e:
-            print(f"   ⚠️  AQI API error: {e}")
+            cls.logger.warning('aqi.error', error=str(e))
             # Return fallback AQI
             aqi_value = 50  # Default to "Good"
             aqi_level, aqi_color, aqi_icon = cls.map_aqi(aqi_value)
@@ -442,6 +2433,20 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
                 'aqiIcon': aqi_icon
             }
     
+    @classmethod
+    def pm25_to_aqi(cls, pm25):
+        """Convert a PM2.5 concentration to AQI using the EPA formula (simplified)"""
+        if pm25 <= 12.0:
+            return int((50 / 12.0) * pm25)
+        elif pm25 <= 35.4:
+            return int(50 + ((100 - 50) / (35.4 - 12.1)) * (pm25 - 12.1))
+        elif pm25 <= 55.4:
+            return int(100 + ((150 - 100) / (55.4 - 35.5)) * (pm25 - 35.5))
+        elif pm25 <= 150.4:
+            return int(150 + ((200 - 150) / (150.4 - 55.5)) * (pm25 - 55.5))
+        else:
+            return int(200 + ((300 - 200) / (250.4 - 150.5)) * (pm25 - 150.5))
+    
     @classmethod
     def map_aqi(cls, aqi):
         """Map AQI value to level, color, and icon"""
@@ -504,54 +2509,193 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
         }
     
     @classmethod
-    def initialize_schedules(cls):
-        """Create initial train schedules for all stations"""
-        cls.schedule_created_at = datetime.now()
-        cls.train_schedules = {}
+    def initialize_schedules(cls, created_at=None):
+        """Start a new schedule epoch; each station's trains are built on first use"""
+        cls.schedule_created_at = created_at or datetime.now()
+        seed = cls.schedule_seed
+        if cls.shared_schedule_epoch is not None:
+            if created_at is None:
+                # A fresh (re)build: publish it so the other workers follow
+                cls.shared_schedule_epoch.value = cls.schedule_created_at.timestamp()
+            if seed is None:
+                # Workers must agree on the trains, so derive the seed from the shared epoch
+                seed = int(cls.shared_schedule_epoch.value * 1000)
+        # A fixed seed makes every rebuild (including /api/reset) produce the same schedules
+        cls.schedule_epoch_seed = seed if seed is not None else random.getrandbits(64)
+        cls.train_schedules = {}
+        
+        cls.logger.info('schedules.initialized', stations=len(cls.STATIONS),
+                        created_at=cls.schedule_created_at.strftime('%H:%M:%S'))
+    
+    @classmethod
+    def get_network(cls):
+        if cls.network is None:
+            with cls.network_lock:
+                if cls.network is None:
+                    started = time.perf_counter()
+                    cls.network = TransitNetwork(cls.STATION_COORDS, cls.BART_LINES)
+                    cls.logger.info('network.built', stations=len(cls.network.codes), lines=len(cls.BART_LINES),
+                                    ms=round((time.perf_counter() - started) * 1000, 1))
+        return cls.network
+    
+    @classmethod
+    def get_station_indexes(cls):
+        if cls.station_indexes is None:
+            with cls.station_indexes_lock:
+                if cls.station_indexes is None:
+                    started = time.perf_counter()
+                    stations = cls.station_catalogue()
+                    by_network = {}
+                    for station in stations:
+                        by_network.setdefault(station['network'], []).append(station)
+                    indexes = {network: StationIndex(members) for network, members in by_network.items()}
+                    indexes['all'] = StationIndex(stations)
+                    cls.station_indexes = indexes
+                    cls.logger.info('stations.indexed', stations=len(stations), networks=len(by_network),
+                                    ms=round((time.perf_counter() - started) * 1000, 1))
+        return cls.station_indexes
+    
+    @classmethod
+    def get_name_indexes(cls):
+        if cls.name_indexes is None:
+            with cls.name_indexes_lock:
+                if cls.name_indexes is None:
+                    started = time.perf_counter()
+                    stations = [{'type': 'station', 'network': station['network'], 'code': station['code'],
+                                 'name': station['name']} for station in cls.station_catalogue()]
+                    cities = [{'type': 'city', 'name': city, 'lat': lat, 'lon': lon}
+                              for city, (lat, lon) in cls.CITY_COORDS.items()]
+                    cls.name_indexes = {'all': PrefixIndex(stations + cities), 'station': PrefixIndex(stations),
+                                        'city': PrefixIndex(cities)}
+                    cls.logger.info('names.indexed', names=len(stations) + len(cities),
+                                    ms=round((time.perf_counter() - started) * 1000, 1))
+        return cls.name_indexes
+    
+    @classmethod
+    def station_catalogue(cls):
+        """Every known station as {network, code, name, lat, lon}.
+        
+        The built-in BART and TfL tables come first; rows of stations_file (CSV with
+        network, code, name, lat and lon columns) add to them or replace entries with
+        the same network and code.
+        """
+        stations = {}
+        for code, (lat, lon) in cls.STATION_COORDS.items():
+            stations[('bart', code)] = {'network': 'bart', 'code': code, 'name': cls.STATIONS.get(code, code),
+                                        'lat': lat, 'lon': lon}
+        for code, info in cls.LONDON_STATIONS.items():
+            stations[('tfl', code)] = {'network': 'tfl', 'code': code, 'name': info['name'],
+                                       'lat': info['lat'], 'lon': info['lon']}
+        if cls.stations_file:
+            with open(cls.stations_file, newline='', encoding='utf-8') as source:
+                for line, row in enumerate(csv.DictReader(source), start=2):
+                    try:
+                        network = row['network'].strip().lower()
+                        station = {'network': network, 'code': row['code'].strip(), 'name': row['name'].strip(),
+                                   'lat': float(row['lat']), 'lon': float(row['lon'])}
+                    except (KeyError, AttributeError, ValueError):
+                        raise ValueError(f"{cls.stations_file} line {line}: expected network, code, name, lat, lon")
+                    stations[(network, station['code'])] = station
+        return list(stations.values())
+    
+    @classmethod
+    def station_destinations(cls, station_code):
+        """(name, code, direction, color, hexcolor, frequency) for trains from a station: its
+        DESTINATIONS entry if it has one, else the far ends of every BART line through it"""
+        destinations = cls.DESTINATIONS.get(station_code)
+        if destinations is not None:
+            return destinations
+        destinations = []
+        seen = set()
+        for line, (hexcolor, frequency, stops) in cls.BART_LINES.items():
+            if station_code not in stops:
+                continue
+            for terminal in (stops[0], stops[-1]):
+                if terminal != station_code and terminal not in seen:
+                    seen.add(terminal)
+                    destinations.append((cls.STATIONS[terminal], terminal,
+                                         cls.compass_direction(station_code, terminal), line, hexcolor, frequency))
+        # Codes outside the network (e.g. synthetic ones) keep the old 12TH stand-in
+        return destinations or cls.DESTINATIONS['12TH']
+    
+    @classmethod
+    def compass_direction(cls, origin, destination):
+        """'North', 'South', 'East' or 'West': the main direction from one station to another"""
+        (lat1, lon1), (lat2, lon2) = cls.STATION_COORDS[origin], cls.STATION_COORDS[destination]
+        north = lat2 - lat1
+        east = (lon2 - lon1) * math.cos(math.radians(lat1))
+        if abs(north) >= abs(east):
+            return 'North' if north > 0 else 'South'
+        return 'East' if east > 0 else 'West'
+    
+    @classmethod
+    def station_schedule(cls, station_code):
+        """Trains for one station, built on first request from a seed of its own.
+        
+        Each station's trains depend only on the epoch seed and the station code, so
+        the order in which stations are first requested does not change them.
+        """
+        schedules = cls.train_schedules
+        trains = schedules.get(station_code)
+        if trains is not None:
+            return trains
+        if station_code not in cls.STATIONS:
+            return []
         
-        for station_code in cls.STATIONS.keys():
-            destinations = cls.DESTINATIONS.get(station_code, cls.DESTINATIONS['12TH'])
-            cls.train_schedules[station_code] = []
+        rng = random.Random(f"{cls.schedule_epoch_seed}:{station_code}")
+        destinations = cls.station_destinations(station_code)
+        trains = []
+        
+        for dest_name, dest_abbr, dest_direction, color, hexcolor, frequency in destinations:
+            num_trains = rng.randint(4, 6)
             
-            for dest_name, dest_abbr, dest_direction, color, hexcolor, frequency in destinations:
-                num_trains = random.randint(4, 6)
+            for i in range(num_trains):
+                initial_minutes = rng.randint(2, 5) + (i * frequency)
                 
-                for i in range(num_trains):
-                    initial_minutes = random.randint(2, 5) + (i * frequency)
-                    
-                    train = {
-                        'id': f"{station_code}_{dest_abbr}_{i}",
-                        'destination': dest_name,
-                        'abbreviation': dest_abbr,
-                        'destination_code': dest_abbr,  # For weather lookup
-                        'direction': dest_direction,
-                        'color': color,
-                        'hexcolor': hexcolor,
-                        'platform': str(random.randint(1, 4)),
-                        'length': str(random.choice([6, 8, 9, 10])),
-                        'initial_arrival_minutes': initial_minutes,
-                        'frequency': frequency,
-                        'delay': random.choice([0, 0, 0, 0, 1, 2])
-                    }
-                    
-                    cls.train_schedules[station_code].append(train)
+                train = {
+                    'id': f"{station_code}_{dest_abbr}_{i}",
+                    'destination': dest_name,
+                    'abbreviation': dest_abbr,
+                    'destination_code': dest_abbr,  # For weather lookup
+                    'direction': dest_direction,
+                    'color': color,
+                    'hexcolor': hexcolor,
+                    'platform': str(rng.randint(1, 4)),
+                    'length': str(rng.choice([6, 8, 9, 10])),
+                    'initial_arrival_minutes': initial_minutes,
+                    'frequency': frequency,
+                    'delay': rng.choice([0, 0, 0, 0, 1, 2])
+                }
+                
+                trains.append(train)
         
-        print(f"🚂 Initialized schedules for {len(cls.train_schedules)} stations")
-        print(f"⏰ Schedule created at: {cls.schedule_created_at.strftime('%H:%M:%S')}")
+        # Concurrent first requests build identical lists; keep whichever landed first
+        return schedules.setdefault(station_code, trains)
     
     @classmethod
-    def get_current_arrivals(cls, station_code):
-        """Get current train arrivals based on elapsed time"""
+    @traced('get_current_arrivals')
+    def get_current_arrivals(cls, station_code, direction=None, include_weather=True, limit=None):
+        """Get current train arrivals based on elapsed time.
+        
+        direction keeps only trains heading that way (case-insensitive); weather is
+        looked up only when include_weather is set, and limit caps estimates per destination.
+        """
         if cls.schedule_created_at is None:
             cls.initialize_schedules()
+        elif cls.shared_schedule_epoch is not None and cls.shared_schedule_epoch.value != cls.schedule_created_at.timestamp():
+            # Another worker rebuilt the schedules (/api/reset); follow it
+            cls.initialize_schedules(datetime.fromtimestamp(cls.shared_schedule_epoch.value))
         
         now = datetime.now()
         elapsed_minutes = (now - cls.schedule_created_at).total_seconds() / 60
         
-        station_trains = cls.train_schedules.get(station_code, [])
+        station_trains = cls.station_schedule(station_code)
         current_arrivals = {}
         
         for train in station_trains:
+            if direction and train['direction'].lower() != direction:
+                continue
+            
             current_arrival = train['initial_arrival_minutes'] - elapsed_minutes
             
             while current_arrival < -1:
@@ -562,7 +2706,7 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
                 
                 if dest_key not in current_arrivals:
                     # Fetch weather for destination
-                    weather_data = cls.get_weather_data(train['destination_code'])
+                    weather_data = cls.get_weather_data(train['destination_code']) if include_weather else None
                     
                     current_arrivals[dest_key] = {
                         'destination': train['destination'],
@@ -575,210 +2719,435 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
                         'estimates': []
                     }
                 
-                if current_arrival <= 0:
-                    minutes_str = 'Leaving'
-                else:
-                    minutes_str = str(int(current_arrival))
-                
+                # Kept numeric; bart_minutes_label formats it when the response is built
                 current_arrivals[dest_key]['estimates'].append({
-                    'minutes': minutes_str,
+                    'minutes': current_arrival,
                     'platform': train['platform'],
                     'length': train['length'],
                     'delay': str(train['delay'])
                 })
         
         for dest in current_arrivals.values():
-            dest['estimates'].sort(key=lambda x: 999 if x['minutes'] == 'Leaving' else int(x['minutes']))
+            dest['estimates'] = cls.soonest(dest['estimates'], limit)
         
         return list(current_arrivals.values())
     
+    @staticmethod
+    def soonest(estimates, limit=None):
+        """Estimates in arrival order, only the first limit of them when given (heap selection)"""
+        if limit is not None and limit < len(estimates):
+            return heapq.nsmallest(limit, estimates, key=itemgetter('minutes'))
+        return sorted(estimates, key=itemgetter('minutes'))
+    
+    @staticmethod
+    def bart_minutes_label(minutes):
+        """BART's display form of an estimate: 'Leaving' once due, else whole minutes"""
+        return 'Leaving' if minutes <= 0 else str(int(minutes))
+    
+    @staticmethod
+    def tfl_minutes_label(minutes):
+        """TfL's display form of an estimate: 'Arriving' under a minute out, else whole minutes"""
+        whole = int(minutes)
+        return 'Arriving' if whole <= 0 else str(whole)
+    
+    def handle(self):
+        """Serve requests on one connection until the client closes it, it sits idle
+        for timeout seconds, it reaches max_keepalive_requests or the server drains"""
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+            while not self.close_connection and self.mark_connection(idle=True):
+                self.handle_one_request()
+        finally:
+            self.mark_connection(idle=False)
+    
+    def mark_connection(self, idle):
+        """Tell a SmartCommuteHTTPServer whether this connection is waiting for a request
+        (False means it is draining); other servers don't track connections"""
+        mark = getattr(self.server, 'mark_idle' if idle else 'mark_busy', None)
+        if mark is None:
+            return True
+        return mark(self.connection) is not False
+    
+    def parse_request(self):
+        # The next request line has arrived, so the connection is no longer idle
+        self.mark_connection(idle=False)
+        self.requests_on_connection += 1
+        return SimpleHTTPRequestHandler.parse_request(self)
+    
+    def discard_body(self):
+        """Read and drop any request body so it isn't parsed as the next request; False after
+        answering 400 (bad Content-Length) or 413 (over MAX_REQUEST_BODY) and closing"""
+        length = (self.headers.get('Content-Length') or '0').strip()
+        if not (length.isascii() and length.isdigit()):
+            self.send_json({'error': 'invalid Content-Length'}, status=400, headers={'Connection': 'close'})
+            return False
+        length = int(length)
+        if length > self.MAX_REQUEST_BODY:
+            self.send_json({'error': f"request body larger than {self.MAX_REQUEST_BODY} bytes"}, status=413,
+                           headers={'Connection': 'close'})
+            return False
+        while length > 0:
+            chunk = self.rfile.read(min(length, 16384))
+            if not chunk:
+                self.close_connection = True
+                break
+            length -= len(chunk)
+        return True
+    
     def end_headers(self):
+        if self.requests_on_connection >= self.max_keepalive_requests or getattr(self.server, 'draining', False):
+            self.send_header('Connection', 'close')
+        elif not self.close_connection:
+            remaining = self.max_keepalive_requests - self.requests_on_connection
+            self.send_header('Keep-Alive', f"timeout={self.timeout:g}, max={remaining}")
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-API-Key')
         SimpleHTTPRequestHandler.end_headers(self)
     
+    def send_response(self, code, message=None):
+        # Remember the status so do_GET can label its request metrics
+        self.response_status = code
+        SimpleHTTPRequestHandler.send_response(self, code, message)
+    
     def do_OPTIONS(self):
+        if not self.discard_body():
+            return
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def do_GET(self):
         parsed_path = urlparse(self.path)
+        route = parsed_path.path if parsed_path.path in self.API_ROUTES else 'static'
+        self.response_status = None
+        started = time.perf_counter()
+        self.logger.sample_request()
+        self.negotiable = parsed_path.path in self.BINARY_ROUTES
+        self.binary = self.negotiable and MessagePackCodec.accepts(self.headers.get('Accept'))
+        if parsed_path.path in self.TRACED_ROUTES:
+            self.tracer.start(parsed_path.path, query=parsed_path.query)
         
-        if parsed_path.path == '/api/bart':
-            self.handle_bart_api(parsed_path)
-        elif parsed_path.path == '/api/tfl':
-            self.handle_tfl_api(parsed_path)
-        elif parsed_path.path == '/api/tfl-status':
-            self.handle_tfl_status(parsed_path)
-        elif parsed_path.path == '/api/weather':
-            self.handle_weather_api(parsed_path)
-        elif parsed_path.path == '/api/reset':
-            self.handle_reset()
-        else:
-            super().do_GET()
+        admitted = None
+        try:
+            if not self.discard_body():
+                return
+            self.follow_reset()
+            if self.rate_limiter.enabled and self.rate_limited({self.RATE_LIMIT_CLASSES.get(parsed_path.path): 1}):
+                return
+            if self.admission.enabled and parsed_path.path not in self.ADMISSION_EXEMPT:
+                priority = 'upstream' if parsed_path.path in self.UPSTREAM_ROUTES else 'cheap'
+                if not self.admit(priority):
+                    return
+                admitted = priority
+            if parsed_path.path == '/api/bart':
+                self.handle_bart_api(parsed_path)
+            elif parsed_path.path == '/api/tfl':
+                self.handle_tfl_api(parsed_path)
+            elif parsed_path.path == '/api/tfl-status':
+                self.handle_tfl_status(parsed_path)
+            elif parsed_path.path == '/api/weather':
+                self.handle_weather_api(parsed_path)
+            elif parsed_path.path == '/api/batch':
+                self.handle_batch(parsed_path)
+            elif parsed_path.path == '/api/history':
+                self.handle_history(parsed_path)
+            elif parsed_path.path == '/api/reliability':
+                self.handle_reliability(parsed_path)
+            elif parsed_path.path == '/api/route':
+                self.handle_route(parsed_path)
+            elif parsed_path.path == '/api/nearest':
+                self.handle_nearest(parsed_path)
+            elif parsed_path.path == '/api/autocomplete':
+                self.handle_autocomplete(parsed_path)
+            elif parsed_path.path == '/api/reset':
+                self.handle_reset()
+            elif parsed_path.path == '/metrics':
+                self.handle_metrics()
+            elif parsed_path.path == '/debug/traces':
+                self.handle_debug_traces(parsed_path)
+            else:
+                super().do_GET()
+        finally:
+            if admitted:
+                self.admission.release(admitted)
+            self.metrics.inc('http_requests_total', (('route', route), ('status', self.response_status or 0)))
+            self.metrics.observe('http_request_duration_seconds', (('route', route),), time.perf_counter() - started)
+            self.tracer.finish(status=self.response_status)
+    
+    def send_json(self, payload, status=200, headers=None):
+        """Encode payload as JSON (or MessagePack, if negotiated) and write it as the response body"""
+        if self.binary:
+            with self.tracer.span('msgpack_encode'):
+                body = MessagePackCodec.encode(payload)
+            self.send_body(body, status, MessagePackCodec.CONTENT_TYPE, headers)
+            return
+        with self.tracer.span('json_encode'):
+            body = json.dumps(payload).encode()
+        self.send_body(body, status, headers=headers)
+    
+    def send_body(self, body, status=200, content_type='application/json', headers=None):
+        """Write an already-encoded response body"""
+        with self.tracer.span('socket_write', bytes=len(body)):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if self.negotiable:
+                self.send_header('Vary', 'Accept')
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+    
+    def admit(self, priority):
+        """Wait for an admission slot; False after sending a 503 if the server is too busy"""
+        with self.tracer.span('admission', priority=priority):
+            rejected = self.admission.acquire(priority)
+        if rejected is None:
+            return True
+        self.metrics.inc('admission_rejected_total', (('priority', priority), ('reason', rejected)))
+        retry_after = max(1, math.ceil(self.admission.max_wait))
+        self.send_json({'error': 'server busy, retry shortly', 'retryAfter': retry_after}, status=503,
+                       headers={'Retry-After': str(retry_after)})
+        self.logger.warning('admission.rejected', sampled=True, priority=priority, reason=rejected)
+        return False
+    
+    def client_key(self):
+        """Who a request is rate limited as: its X-API-Key if that is a configured key, else
+        its IP address"""
+        api_key = self.headers.get('X-API-Key')
+        if api_key and api_key in self.rate_limiter.api_keys:
+            return 'key:' + api_key
+        return self.client_address[0]
+    
+    def rate_limited(self, costs):
+        """Charge {endpoint class: tokens} to this client; True after sending a 429 if any bucket is short"""
+        client = self.client_key()
+        wait = 0.0
+        for endpoint_class, cost in costs.items():
+            class_wait = self.rate_limiter.take(client, endpoint_class, cost)
+            if class_wait:
+                self.metrics.inc('rate_limited_total', (('class', endpoint_class),))
+                wait = max(wait, class_wait)
+        if not wait:
+            return False
+        retry_after = max(1, math.ceil(wait))
+        self.send_json({'error': 'rate limit exceeded', 'retryAfter': retry_after}, status=429,
+                       headers={'Retry-After': str(retry_after)})
+        self.logger.info('rate.limited', sampled=True, client=client, retry_after=retry_after)
+        return True
+    
+    def handle_debug_traces(self, parsed_path):
+        """Return the most recent request traces from the ring buffer"""
+        params = parse_qs(parsed_path.query)
+        try:
+            limit = min(self.parse_limit(params) or 50, self.tracer.capacity)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, status=400)
+            return
+        self.send_json({
+            'sampleRate': self.tracer.sample_rate,
+            'traces': self.tracer.recent(limit)
+        })
+    
+    def handle_metrics(self):
+        """Expose request, upstream and cache metrics in Prometheus text format"""
+        body = self.metrics.render().encode()
+        self.send_body(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+    
+    @classmethod
+    def fetch_tfl_arrivals(cls, station_id):
+        """(arrivals, age) for a TfL station. age is None for a live fetch; once the tfl budget
+        is spent it is the seconds since the last good fetch, whose timeToStation values are
+        brought forward by that much. BudgetExhausted if there is nothing to fall back on."""
+        arrivals_url = f"{cls.TFL_BASE_URL}/StopPoint/{station_id}/Arrivals"
+        try:
+            # TfL needs a browser User-Agent header to avoid 403 errors
+            arrivals = cls.fetch_json(arrivals_url, timeout=10, headers=cls.TFL_HEADERS)
+        except BudgetExhausted:
+            snapshot = cls.tfl_arrivals.get(station_id)
+            if snapshot is None:
+                raise
+            fetched_at, arrivals = snapshot
+            age = int(time.time() - fetched_at)
+            return [dict(arrival, timeToStation=arrival['timeToStation'] - age) for arrival in arrivals
+                    if arrival.get('timeToStation', 0) >= age], age
+        if station_id in cls.LONDON_STATIONS:
+            cls.tfl_arrivals[station_id] = (time.time(), arrivals)
+        return arrivals, None
     
     def handle_tfl_api(self, parsed_path):
         """Handle TfL London Underground arrivals"""
         try:
             params = parse_qs(parsed_path.query)
             station_id = params.get('station', ['940GZZLUKSX'])[0]
+            try:
+                fields = self.parse_fields(params, self.TFL_FIELDS)
+                limit = self.parse_limit(params)
+                rank = self.parse_limit(params, 'rank')
+            except ValueError as e:
+                self.send_json({'error': str(e)}, status=400)
+                return
             
             station_info = self.LONDON_STATIONS.get(station_id, {'name': 'Unknown', 'lat': 51.5074, 'lon': -0.1278})
             station_name = station_info['name']
             
-            # Fetch live arrivals from TfL API
-            # Note: TfL API now requires app_id instead of app_key
-            arrivals_url = f"{self.TFL_BASE_URL}/StopPoint/{station_id}/Arrivals"
-            
-            print(f"\n{'='*60}")
-            print(f"🚇 TfL Request:")
-            print(f"   Station: {station_name} ({station_id})")
-            print(f"   URL: {arrivals_url}")
+            if rank is not None:
+                ranking = self.ranking.ranked(('tfl', station_id), self.ranking.snapshot(),
+                                              lambda: BARTProxyHandler.tfl_options(station_id, station_info))
+                self.send_json({'station': {'name': station_name, 'id': station_id}, 'ranked': ranking[:rank]})
+                return
             
-            ssl_context = ssl._create_unverified_context()
-            request = urllib.request.Request(arrivals_url)
-            # Add User-Agent header to avoid 403 errors
-            request.add_header('User-Agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36')
-            
-            with urllib.request.urlopen(request, context=ssl_context, timeout=10) as response:
-                arrivals_data = json.loads(response.read().decode())
+            # Fetch live arrivals from TfL API (or the last good ones if the budget is spent)
+            self.logger.info('tfl.request', sampled=True, station=station_name, station_id=station_id)
+            arrivals_data, age = BARTProxyHandler.fetch_tfl_arrivals(station_id)
             
             # Get weather for station
-            weather_data = BARTProxyHandler.get_weather_data_by_coords(
-                station_info['lat'], 
-                station_info['lon'],
-                station_name
-            )
+            weather_data = None
+            if fields is None or 'weather' in fields:
+                weather_data = BARTProxyHandler.get_weather_data_by_coords(
+                    station_info['lat'], 
+                    station_info['lon'],
+                    station_name
+                )
             
             # Process arrivals
-            trains = []
-            seen_destinations = {}
-            
-            for arrival in arrivals_data:
-                destination = arrival.get('destinationName', 'Unknown')
-                line_name = arrival.get('lineName', 'Unknown')
-                platform = arrival.get('platformName', 'Platform').replace('Platform ', '')
-                time_to_station = arrival.get('timeToStation', 0)
-                current_location = arrival.get('currentLocation', '')
-                
-                # Convert seconds to minutes
-                minutes = int(time_to_station / 60)
-                
-                # Get line color
-                line_color = BARTProxyHandler.get_tube_line_color(line_name)
-                
-                # Create unique key for destination+line
-                dest_key = f"{line_name}_{destination}"
-                
-                if dest_key not in seen_destinations:
-                    seen_destinations[dest_key] = {
-                        'destination': destination,
-                        'line': line_name,
-                        'color': line_color,
-                        'weather': weather_data,
-                        'estimates': []
-                    }
-                
-                # Only add if within 30 minutes
-                if minutes <= 30:
-                    seen_destinations[dest_key]['estimates'].append({
-                        'minutes': 'Arriving' if minutes <= 0 else str(minutes),
-                        'platform': platform,
-                        'currentLocation': current_location
-                    })
+            with self.tracer.span('process_arrivals', count=len(arrivals_data)):
+                trains = BARTProxyHandler.group_tfl_arrivals(arrivals_data, weather_data, limit)
             
-            # Sort estimates by time
-            for dest in seen_destinations.values():
-                dest['estimates'].sort(key=lambda x: 999 if x['minutes'] == 'Arriving' else int(x['minutes']))
-                trains.append(dest)
-            
-            print(f"   Found {len(trains)} destinations")
-            print(f"{'='*60}")
-            
-            result = {
-                'station': {
-                    'name': station_name,
-                    'id': station_id
-                },
-                'trains': trains,
-                'weather': weather_data
-            }
+            self.logger.info('tfl.arrivals', sampled=True, station_id=station_id, destinations=len(trains))
+            if age is None:
+                self.record_tfl_history(station_id, trains)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
+            with self.tracer.span('build_response'):
+                if self.binary:
+                    document = BARTProxyHandler.tfl_document(station_name, station_id, trains, weather_data, fields)
+                    if age is not None:
+                        document.update(stale=True, ageSeconds=age)
+                else:
+                    weather_key = f"{station_info['lat']},{station_info['lon']}"
+                    body = BARTProxyHandler.build_tfl_response(station_name, station_id, trains, weather_key,
+                                                               weather_data, fields)
+                    if age is not None:
+                        body = body[:-1] + f', "stale": true, "ageSeconds": {age}}}'.encode()
             
-            print(f"✅ TfL response sent\n")
+            if self.binary:
+                self.send_json(document)
+            else:
+                self.send_body(body)
+            
+            self.logger.debug('tfl.sent', sampled=True, station_id=station_id)
             
+        except BudgetExhausted as e:
+            retry_after = self.budget.retry_after('tfl')
+            self.logger.warning('tfl.budget_spent', sampled=True, error=str(e), retry_after=retry_after)
+            self.send_json({'error': str(e.reason), 'retryAfter': retry_after}, status=503,
+                           headers={'Retry-After': str(retry_after)})
         except Exception as e:
-            print(f"\n❌ TfL API Error: {e}")
-            import traceback
-            traceback.print_exc()
+            self.logger.exception('tfl.error', error=str(e))
             
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            error_response = json.dumps({'error': str(e)})
-            self.wfile.write(error_response.encode())
+            self.send_json({'error': str(e)}, status=500)
     
     def handle_tfl_status(self, parsed_path):
         """Handle TfL line status requests"""
         try:
+            cached = self.cached_response('line_status', 'tube', self.LINE_STATUS_CACHE_TTL)
+            if cached is not None:
+                self.send_json(cached)
+                return
+            
             # Fetch line status from TfL API
             status_url = f"{self.TFL_BASE_URL}/Line/Mode/tube/Status"
             
-            ssl_context = ssl._create_unverified_context()
-            request = urllib.request.Request(status_url)
-            request.add_header('User-Agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36')
-            
-            with urllib.request.urlopen(request, context=ssl_context, timeout=10) as response:
-                status_data = json.loads(response.read().decode())
+            status_data = self.fetch_json(status_url, timeout=10, headers=self.TFL_HEADERS)
             
             # Process line statuses
-            line_statuses = []
-            for line in status_data:
-                line_id = line.get('id', '')
-                line_name = line.get('name', '')
-                line_statuses_list = line.get('lineStatuses', [])
+            with self.tracer.span('process_lines', count=len(status_data)):
+                line_statuses = []
+                for line in status_data:
+                    line_id = line.get('id', '')
+                    line_name = line.get('name', '')
+                    line_statuses_list = line.get('lineStatuses', [])
                 
-                status_severity = 10  # Good service
-                status_reason = 'Good service'
+                    status_severity = 10  # Good service
+                    status_reason = 'Good service'
                 
-                if line_statuses_list:
-                    status_severity = line_statuses_list[0].get('statusSeverity', 10)
-                    status_reason = line_statuses_list[0].get('statusSeverityDescription', 'Good service')
+                    if line_statuses_list:
+                        status_severity = line_statuses_list[0].get('statusSeverity', 10)
+                        status_reason = line_statuses_list[0].get('statusSeverityDescription', 'Good service')
                     
-                    # Check for disruption reason
-                    if 'reason' in line_statuses_list[0]:
-                        status_reason = line_statuses_list[0]['reason']
+                        # Check for disruption reason
+                        if 'reason' in line_statuses_list[0]:
+                            status_reason = line_statuses_list[0]['reason']
                 
-                line_statuses.append({
-                    'id': line_id,
-                    'name': line_name,
-                    'color': BARTProxyHandler.get_tube_line_color(line_name),
-                    'severity': status_severity,
-                    'status': status_reason
-                })
+                    line_statuses.append({
+                        'id': line_id,
+                        'name': line_name,
+                        'color': BARTProxyHandler.get_tube_line_color(line_name),
+                        'severity': status_severity,
+                        'status': status_reason
+                    })
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'lines': line_statuses}).encode())
+            payload = {'lines': line_statuses}
+            self.store_response('line_status', 'tube', payload)
+            for line in line_statuses:
+                self.history.record('tfl_severity', line['id'], line['severity'])
+            self.send_json(payload)
             
-            print(f"✅ Line status sent\n")
+            self.logger.debug('tfl_status.sent', sampled=True, lines=len(line_statuses))
             
         except Exception as e:
-            print(f"\n❌ Line Status Error: {e}")
-            import traceback
-            traceback.print_exc()
+            self.logger.exception('tfl_status.error', error=str(e))
             
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            error_response = json.dumps({'error': str(e)})
-            self.wfile.write(error_response.encode())
+            self.send_json({'error': str(e)}, status=500)
+    
+    @classmethod
+    def group_tfl_arrivals(cls, arrivals_data, weather_data, limit=None):
+        """Group raw TfL arrivals by line and destination, soonest first, keeping at most limit
+        estimates per group"""
+        trains = []
+        seen_destinations = {}
+        
+        for arrival in arrivals_data:
+            destination = arrival.get('destinationName', 'Unknown')
+            line_name = arrival.get('lineName', 'Unknown')
+            platform = arrival.get('platformName', 'Platform').replace('Platform ', '')
+            time_to_station = arrival.get('timeToStation', 0)
+            current_location = arrival.get('currentLocation', '')
+        
+            # Convert seconds to minutes (kept fractional for ordering)
+            minutes = time_to_station / 60
+        
+            # Get line color
+            line_color = cls.get_tube_line_color(line_name)
+        
+            # Create unique key for destination+line
+            dest_key = f"{line_name}_{destination}"
+        
+            if dest_key not in seen_destinations:
+                seen_destinations[dest_key] = {
+                    'destination': destination,
+                    'line': line_name,
+                    'color': line_color,
+                    'weather': weather_data,
+                    'estimates': []
+                }
+        
+            # Only add if within 30 minutes
+            if int(minutes) <= 30:
+                seen_destinations[dest_key]['estimates'].append({
+                    'minutes': minutes,
+                    'platform': platform,
+                    'currentLocation': current_location
+                })
+        
+        # Order estimates by time, 'Arriving' first
+        for dest in seen_destinations.values():
+            dest['estimates'] = cls.soonest(dest['estimates'], limit)
+            trains.append(dest)
+        
+        return trains
     
     @classmethod
     def get_tube_line_color(cls, line_name):
@@ -802,23 +3171,19 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
         return colors.get(line_name, '#667eea')
     
     @classmethod
+    @traced('get_weather_data_by_coords')
     def get_weather_data_by_coords(cls, lat, lon, location_name):
         """Fetch weather data by coordinates"""
         cache_key = f"{lat},{lon}"
-        if cache_key in cls.weather_cache:
-            cache_age = (datetime.now() - cls.weather_cache_time[cache_key]).total_seconds()
-            if cache_age < 600:  # 10 minutes
-                return cls.weather_cache[cache_key]
+        cached = cls.cached_weather(cache_key)
+        if cached is not None:
+            return cached
         
         try:
             # Open-Meteo API
-            weather_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&temperature_unit=celsius&wind_speed_unit=kmh"
-            
-            ssl_context = ssl._create_unverified_context()
-            request = urllib.request.Request(weather_url)
+            weather_url = f"{cls.OPEN_METEO_URL}?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,weather_code,wind_speed_10m,surface_pressure,visibility&temperature_unit=celsius&wind_speed_unit=kmh"
             
-            with urllib.request.urlopen(request, context=ssl_context, timeout=5) as response:
-                data = json.loads(response.read().decode())
+            data = cls.fetch_json(weather_url, timeout=5)
             
             current = data.get('current', {})
             weather_code = current.get('weather_code', 0)
@@ -838,15 +3203,15 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
             aqi_data = cls.get_real_aqi(lat, lon)
             weather_data.update(aqi_data)
             
-            cls.weather_cache[cache_key] = weather_data
-            cls.weather_cache_time[cache_key] = datetime.now()
+            cls.store_weather(cache_key, weather_data)
             
-            print(f"   🌤️  Weather for {location_name}: {weather_data['temp']}°C, {weather_data['condition']}")
+            cls.logger.info('weather.fetched', sampled=True, location=location_name,
+                            temp=weather_data['temp'], condition=weather_data['condition'])
             
             return weather_data
             
         except Exception as e:
-            print(f"   ⚠️  Weather API error: {e}")
+            cls.logger.warning('weather.error', location=location_name, error=str(e))
             return cls.get_fallback_weather()
     
     def handle_weather_api(self, parsed_path):
@@ -856,136 +3221,949 @@ class BARTProxyHandler(SimpleHTTPRequestHandler):
             city = params.get('city', ['San Francisco'])[0]
             days = int(params.get('days', ['7'])[0])
             
+            if city not in self.CITY_COORDS:
+                # Accept any case or accents ('paris', 'PARÍS'); anything else gets suggestions
+                cities = self.get_name_indexes()['city']
+                matches = cities.exact(city)
+                if not matches:
+                    self.send_json({'error': f"unknown city: {city}",
+                                    'suggestions': [match['name'] for match in cities.suggest(city)]}, status=404)
+                    return
+                city = matches[0]['name']
+            
             forecast_data = BARTProxyHandler.get_weather_forecast(city, days)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(forecast_data).encode())
+            self.send_json(forecast_data)
             
-            print(f"✅ Weather forecast sent for {city}\n")
+            self.logger.debug('forecast.sent', sampled=True, city=city)
             
         except Exception as e:
-            print(f"\n❌ Weather API Error: {e}")
-            import traceback
-            traceback.print_exc()
+            self.logger.exception('forecast_api.error', error=str(e))
             
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            error_response = json.dumps({'error': str(e)})
-            self.wfile.write(error_response.encode())
+            self.send_json({'error': str(e)}, status=500)
+    
+    def handle_autocomplete(self, parsed_path):
+        """Stations and cities whose name, or a word in it, starts with q.
+        
+        /api/autocomplete?q=oak&limit=10, optionally with type=station or type=city.
+        """
+        params = parse_qs(parsed_path.query)
+        text = params.get('q', [''])[0]
+        try:
+            limit = min(self.parse_limit(params) or 10, self.AUTOCOMPLETE_MAX)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, status=400)
+            return
+        kind = params.get('type', ['all'])[0].lower()
+        index = self.get_name_indexes().get(kind)
+        if index is None:
+            self.send_json({'error': 'type must be station, city or all'}, status=400)
+            return
+        self.send_json({'query': text, 'matches': index.search(text, limit)})
+    
+    def handle_nearest(self, parsed_path):
+        """The k stations closest to a point, from the spatial index.
+        
+        /api/nearest?lat=37.8&lon=-122.27&k=5, optionally with network=bart or network=tfl.
+        """
+        params = parse_qs(parsed_path.query)
+        try:
+            lat = float(params['lat'][0])
+            lon = float(params['lon'][0])
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValueError
+        except (KeyError, ValueError):
+            self.send_json({'error': 'lat and lon must be given in decimal degrees'}, status=400)
+            return
+        try:
+            k = min(self.parse_limit(params, 'k') or 5, self.NEAREST_MAX_K)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, status=400)
+            return
+        network = params.get('network', ['all'])[0].lower()
+        indexes = self.get_station_indexes()
+        index = indexes.get(network)
+        if index is None:
+            self.send_json({'error': f"network must be one of {', '.join(sorted(indexes))}"}, status=400)
+            return
+        with self.tracer.span('nearest', stations=len(index)):
+            results = index.nearest(lat, lon, k)
+        self.send_json({
+            'lat': lat,
+            'lon': lon,
+            'stations': [dict(station, distanceKm=round(distance, 3)) for distance, station in results]
+        })
+    
+    def handle_route(self, parsed_path):
+        """Fastest trip between two BART stations, looked up in the precomputed network"""
+        params = parse_qs(parsed_path.query)
+        origin = params.get('from', [''])[0]
+        destination = params.get('to', [''])[0]
+        network = self.get_network()
+        unknown = [code for code in (origin, destination) if code not in network.index]
+        if unknown:
+            self.send_json({'error': f"unknown station: {', '.join(repr(code) for code in unknown)}; "
+                                     'pass BART codes as from= and to=, e.g. from=12TH&to=SFIA'}, status=400)
+            return
+        trip = network.trip(origin, destination)
+        if trip is None:
+            self.send_json({'error': f"no route from {origin} to {destination}"}, status=404)
+            return
+        minutes, transfers, legs = trip
+        self.send_json({
+            'from': {'abbr': origin, 'name': self.STATIONS[origin]},
+            'to': {'abbr': destination, 'name': self.STATIONS[destination]},
+            'minutes': round(minutes, 1),
+            'transfers': transfers,
+            'legs': [{
+                'line': line,
+                'hexcolor': self.BART_LINES[line][0],
+                'from': board,
+                'to': alight,
+                'stops': stops,
+                'minutes': round(leg_minutes, 1)
+            } for line, board, alight, stops, leg_minutes in legs]
+        })
+    
+    def handle_history(self, parsed_path):
+        """Recorded samples for one series over a time range, or the series available.
+    
+        /api/history lists the series; /api/history?metric=temperature&key=12TH&from=&to=
+        returns its buckets, with from and to in epoch seconds (default: the whole window).
+        """
+        params = parse_qs(parsed_path.query)
+        metric = params.get('metric', [None])[0]
+        key = params.get('key', [None])[0]
+        history = self.history
+        window = {'resolution': history.resolution, 'slots': history.slots}
+        if metric is None or key is None:
+            self.send_json(dict(window, series=history.keys()))
+            return
+        try:
+            start = float(params['from'][0]) if 'from' in params else None
+            end = float(params['to'][0]) if 'to' in params else None
+        except ValueError:
+            self.send_json({'error': 'from and to must be epoch seconds'}, status=400)
+            return
+        points = history.query(metric, key, start, end)
+        if points is None:
+            self.send_json({'error': f"no history for {metric} {key}"}, status=404)
+            return
+        self.send_json(dict(window, metric=metric, key=key, points=[
+            {'time': at, 'count': count, 'mean': round(mean, 2), 'min': round(low, 2), 'max': round(high, 2)}
+            for at, count, mean, low, high in points]))
+    
+    @classmethod
+    def record_bart_history(cls, station, arrivals):
+        """Soonest estimate per destination and mean delay at a station, as history samples"""
+        delays = []
+        for arrival in arrivals:
+            if arrival['estimates']:
+                cls.history.record('bart_minutes', f"{station}>{arrival['abbreviation']}",
+                                   arrival['estimates'][0]['minutes'])
+            delays.extend(int(estimate['delay']) for estimate in arrival['estimates'])
+        if delays:
+            cls.history.record('bart_delay', station, sum(delays) / len(delays))
+    
+    @classmethod
+    def record_tfl_history(cls, station_id, trains):
+        """Soonest estimate per line at a TfL station, as history samples"""
+        soonest_by_line = {}
+        for train in trains:
+            if train['estimates']:
+                minutes = train['estimates'][0]['minutes']
+                soonest_by_line[train['line']] = min(minutes, soonest_by_line.get(train['line'], minutes))
+        for line, minutes in soonest_by_line.items():
+            cls.history.record('tfl_minutes', f"{station_id}>{line}", minutes)
+    
+    def handle_reliability(self, parsed_path):
+        """On-time statistics over the rolling window, for one scope or key or for everything.
+
+        /api/reliability?scope=line&key=YELLOW; scope is line, destination or station.
+        """
+        params = parse_qs(parsed_path.query)
+        scope_name = params.get('scope', [None])[0]
+        key = params.get('key', [None])[0]
+        if scope_name is not None and scope_name not in self.RELIABILITY_SCOPES:
+            self.send_json({'error': f"scope must be one of {', '.join(self.RELIABILITY_SCOPES)}"}, status=400)
+            return
+        reliability = self.reliability
+        settings = {'window': reliability.span * reliability.subwindows, 'onTimeMinutes': reliability.on_time_minutes}
+        if key is not None:
+            stats = reliability.summary((scope_name or 'station', key))
+            if stats is None:
+                self.send_json({'error': f"no departures seen for {scope_name or 'station'} {key}"}, status=404)
+                return
+            self.send_json(dict(settings, scope=scope_name or 'station', key=key, stats=stats))
+            return
+        scopes = {}
+        for scope in reliability.keys(scope_name):
+            scopes.setdefault(scope[0], {})[scope[1]] = reliability.summary(scope)
+        self.send_json(dict(settings, scopes=scopes))
+    
+    @classmethod
+    def record_departures(cls, station):
+        """Count each of a station's simulated trains' departures once, with its delay, in the
+        sub-window each departure actually fell in"""
+        created = cls.schedule_created_at.timestamp()
+        elapsed = (time.time() - created) / 60
+        # Departures missed while nobody asked for this station only count if still in the window
+        horizon = elapsed - cls.reliability.span * cls.reliability.subwindows / 60
+        for train in cls.station_schedule(station):
+            since_first = elapsed - train['initial_arrival_minutes']
+            departures = int(since_first // train['frequency']) + 1 if since_first >= 0 else 0
+            new = cls.reliability.count_departures(train['id'], departures)
+            if not new:
+                continue
+            first = max(departures - new,
+                        math.ceil((horizon - train['initial_arrival_minutes']) / train['frequency']))
+            by_window = {}
+            for n in range(first, departures):
+                at = created + (train['initial_arrival_minutes'] + n * train['frequency']) * 60
+                window_index = int(at // cls.reliability.span)
+                by_window[window_index] = (by_window.get(window_index, (0, at))[0] + 1, at)
+            scopes = (('line', train['color']), ('destination', train['abbreviation']), ('station', station))
+            for count, at in by_window.values():
+                cls.reliability.record(scopes, train['delay'], count, at=at)
+    
+    def handle_batch(self, parsed_path):
+        """Run several API queries concurrently and return their responses in one body.
+        
+        Each sub-query is a URL-encoded path passed as q, e.g.
+        /api/batch?q=%2Fapi%2Fbart%3Fstation%3D12TH&q=%2Fapi%2Ftfl-status
+        """
+        queries = parse_qs(parsed_path.query).get('q', [])
+        if not queries:
+            self.send_json({'error': 'pass each sub-query as a URL-encoded q parameter'}, status=400)
+            return
+        if len(queries) > self.BATCH_MAX_QUERIES:
+            self.send_json({'error': f"at most {self.BATCH_MAX_QUERIES} queries per batch"}, status=400)
+            return
+        
+        if self.rate_limiter.enabled:
+            # Charge each sub-query to its own endpoint class, as if it were sent directly
+            costs = {}
+            for query in queries:
+                endpoint_class = self.RATE_LIMIT_CLASSES.get(urlparse(query).path)
+                costs[endpoint_class] = costs.get(endpoint_class, 0) + 1
+            if self.rate_limited(costs):
+                return
+        
+        sampled = self.logger.request_sampled()
+        with self.tracer.span('batch', queries=len(queries)):
+            results = self.run_batch(queries, sampled)
+        
+        # Sub-responses are already JSON; splice them in rather than decoding and re-encoding
+        items = [b'{"query": ' + json.dumps(query).encode() + b', "status": ' + str(status).encode()
+                 + b', "body": ' + body + b'}'
+                 for query, (status, body) in zip(queries, results)]
+        self.send_body(b'{"results": [' + b', '.join(items) + b']}')
+        self.logger.debug('batch.sent', sampled=True, queries=len(queries))
+    
+    @classmethod
+    def get_batch_executor(cls):
+        with cls.batch_executor_lock:
+            if cls.batch_executor is None:
+                cls.batch_executor = ThreadPoolExecutor(max_workers=cls.BATCH_CONCURRENCY,
+                                                        thread_name_prefix='batch')
+            return cls.batch_executor
+    
+    @classmethod
+    def run_batch(cls, queries, sampled=True):
+        """(status, body) for each sub-query in order, with at most BATCH_PER_REQUEST in flight"""
+        executor = cls.get_batch_executor()
+        results = [None] * len(queries)
+        running = {}  # future -> position in queries
+        for position, query in enumerate(queries):
+            if len(running) >= cls.BATCH_PER_REQUEST:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+            running[executor.submit(cls.run_batch_query, query, sampled)] = position
+        for future, position in running.items():
+            results[position] = future.result()
+        return results
+    
+    @classmethod
+    def run_batch_query(cls, query, sampled=True):
+        """(status, body) for one sub-query, produced by the same handler a direct request uses"""
+        cls.logger.sample_request(sampled)
+        parsed = urlparse(query)
+        method = cls.BATCH_HANDLERS.get(parsed.path)
+        if method is None:
+            status, body = 404, json.dumps({'error': f"{parsed.path} cannot be batched"}).encode()
+        else:
+            request = CapturedRequest(query)
+            getattr(request, method)(parsed)
+            status, body = request.response_status, request.body
+        route = parsed.path if method else 'other'
+        cls.metrics.inc('batch_queries_total', (('route', route), ('status', status)))
+        return status, body
+    
+    @classmethod
+    def drop_local_caches(cls):
+        """Forget this process's weather and response caches"""
+        cls.weather_cache = {}
+        cls.weather_cache_json = {}
+        cls.weather_cache_time = {}
+        cls.response_cache = {}
+    
+    @classmethod
+    def follow_reset(cls):
+        """Drop the local caches if another worker answered /api/reset since we last looked"""
+        if cls.shared_reset_count is not None and cls.shared_reset_count.value != cls.reset_seen:
+            cls.reset_seen = cls.shared_reset_count.value
+            cls.drop_local_caches()
     
     def handle_reset(self):
         """Reset the schedule"""
         BARTProxyHandler.initialize_schedules()
-        BARTProxyHandler.weather_cache = {}
-        BARTProxyHandler.weather_cache_time = {}
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        response = {'status': 'Schedule and weather cache reset successfully'}
-        self.wfile.write(json.dumps(response).encode())
-        print("🔄 Schedule and cache reset!")
+        BARTProxyHandler.drop_local_caches()
+        if BARTProxyHandler.shared_reset_count is not None:
+            BARTProxyHandler.shared_reset_count.value += 1
+            BARTProxyHandler.reset_seen = BARTProxyHandler.shared_reset_count.value
+        if BARTProxyHandler.shared_weather is not None:
+            BARTProxyHandler.shared_weather.clear()
+        if BARTProxyHandler.persistent_cache.enabled:
+            BARTProxyHandler.persistent_cache.clear()
+        self.send_json({'status': 'Schedule and weather cache reset successfully'})
+        self.logger.info('schedule.reset')
+    
+    @classmethod
+    def encoded_weather(cls, cache_key, weather_data):
+        """JSON bytes for a weather dict, reusing the encoding stored with its cache entry"""
+        encoded = cls.weather_cache_json.get(cache_key)
+        if encoded is None or cls.weather_cache.get(cache_key) is not weather_data:
+            # Fallback data is never cached, so it is encoded per use
+            encoded = json.dumps(weather_data).encode()
+        return encoded
+    
+    @staticmethod
+    def parse_fields(params, allowed):
+        """Requested fields= as a set, or None for everything; ValueError names unknown ones"""
+        if 'fields' not in params:
+            return None
+        fields = {name.strip() for value in params['fields'] for name in value.split(',') if name.strip()}
+        unknown = fields - set(allowed)
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}; choose from {', '.join(allowed)}")
+        return fields
+    
+    @staticmethod
+    def parse_limit(params, name='limit'):
+        """Requested limit= (estimates per destination), or another positive count, as an int;
+        None when absent"""
+        if name not in params:
+            return None
+        try:
+            limit = int(params[name][0])
+        except ValueError:
+            limit = -1
+        if limit < 1:
+            raise ValueError(f"{name} must be a positive integer")
+        return limit
+    
+    @classmethod
+    def project_bart_etd(cls, arrival, fields):
+        """One etd entry restricted to fields, keys in the usual order"""
+        etd = {}
+        if 'destination' in fields:
+            etd['destination'] = arrival['destination']
+        if 'abbreviation' in fields:
+            etd['abbreviation'] = arrival['abbreviation']
+        if 'limited' in fields:
+            etd['limited'] = '0'
+        if 'estimate' in fields:
+            etd['estimate'] = [{
+                'minutes': cls.bart_minutes_label(est['minutes']),
+                'platform': est['platform'],
+                'direction': arrival['direction'],
+                'length': est['length'],
+                'color': arrival['color'],
+                'hexcolor': arrival['hexcolor'],
+                'bikeflag': '1',
+                'delay': est['delay']
+            } for est in arrival['estimates']]
+        if 'weather' in fields:
+            etd['weather'] = arrival['weather']
+        return etd
+    
+    @classmethod
+    def build_bart_response(cls, station, station_name, arrivals, fields=None):
+        """Assemble the BART-compatible ETD JSON by splicing pre-encoded fragments.
+        
+        Only the date, time and per-train minutes are serialized per request; the
+        output is byte-for-byte what json.dumps would produce for the same dict.
+        With fields, each etd keeps only those keys and is encoded directly.
+        """
+        fragments = cls.json_fragments
+        
+        station_key = ('station', station, station_name)
+        station_parts = fragments.get(station_key)
+        if station_parts is None:
+            uri = json.dumps({'#cdata-section': 'http://api.bart.gov/api/etd.aspx?cmd=etd&orig=' + station})
+            station_parts = (
+                f'{{"root": {{"uri": {uri}, "date": '.encode(),
+                f', "station": [{{"name": {json.dumps(station_name)}, "abbr": {json.dumps(station)}, "etd": ['.encode()
+            )
+            # Unknown codes come straight from the query string; don't let them grow the cache
+            if station in cls.STATIONS:
+                fragments[station_key] = station_parts
+        
+        etds = []
+        for arrival in arrivals:
+            if fields is not None:
+                etds.append(json.dumps(cls.project_bart_etd(arrival, fields)).encode())
+                continue
+            
+            etd_key = ('etd', arrival['destination'], arrival['abbreviation'])
+            etd_head = fragments.get(etd_key)
+            if etd_head is None:
+                etd_head = fragments[etd_key] = (
+                    f'{{"destination": {json.dumps(arrival["destination"])}, '
+                    f'"abbreviation": {json.dumps(arrival["abbreviation"])}, "limited": "0", "estimate": ['
+                ).encode()
+            
+            estimates = []
+            for est in arrival['estimates']:
+                label = cls.bart_minutes_label(est['minutes'])
+                minutes_key = ('minutes', label)
+                minutes = fragments.get(minutes_key)
+                if minutes is None:
+                    minutes = fragments[minutes_key] = f'{{"minutes": {json.dumps(label)}'.encode()
+                
+                tail_key = ('estimate', est['platform'], arrival['direction'], est['length'],
+                            arrival['color'], arrival['hexcolor'], est['delay'])
+                tail = fragments.get(tail_key)
+                if tail is None:
+                    tail = fragments[tail_key] = json.dumps({
+                        'platform': est['platform'],
+                        'direction': arrival['direction'],
+                        'length': est['length'],
+                        'color': arrival['color'],
+                        'hexcolor': arrival['hexcolor'],
+                        'bikeflag': '1',
+                        'delay': est['delay']
+                    }).encode().replace(b'{', b', ', 1)  # continues the object the minutes piece opened
+                estimates.append(minutes + tail)
+            
+            weather = cls.encoded_weather(arrival['destination_code'], arrival['weather'])
+            etds.append(etd_head + b', '.join(estimates) + b'], "weather": ' + weather + b'}')
+        
+        return b''.join((
+            station_parts[0], json.dumps(time.strftime('%m/%d/%Y')).encode(),
+            b', "time": ', json.dumps(time.strftime('%I:%M:%S %p')).encode(),
+            station_parts[1], b', '.join(etds), b']}], "message": ""}}'
+        ))
+    
+    @classmethod
+    def tfl_estimates(cls, estimates):
+        """Estimates as sent to clients, with minutes formatted"""
+        return [{
+            'minutes': cls.tfl_minutes_label(est['minutes']),
+            'platform': est['platform'],
+            'currentLocation': est['currentLocation']
+        } for est in estimates]
+    
+    @classmethod
+    def build_tfl_response(cls, station_name, station_id, trains, weather_key, weather_data, fields=None):
+        """Assemble the TfL arrivals JSON, encoding the shared weather object only once.
+        
+        With fields, each train keeps only those keys, and the station-level weather
+        is included only if 'weather' is one of them.
+        """
+        fragments = cls.json_fragments
+        if fields is not None and 'weather' not in fields:
+            weather = None
+        else:
+            weather = cls.encoded_weather(weather_key, weather_data)
+        
+        station_key = ('tfl-station', station_id, station_name)
+        head = fragments.get(station_key)
+        if head is None:
+            head = f'{{"station": {json.dumps({"name": station_name, "id": station_id})}, "trains": ['.encode()
+            if station_id in cls.LONDON_STATIONS:
+                fragments[station_key] = head
+        
+        encoded_trains = []
+        for train in trains:
+            if fields is not None:
+                projected = {key: train[key] for key in cls.TFL_FIELDS if key in fields}
+                if 'estimates' in projected:
+                    projected['estimates'] = cls.tfl_estimates(train['estimates'])
+                encoded_trains.append(json.dumps(projected).encode())
+                continue
+            
+            train_key = ('tfl-train', train['destination'], train['line'], train['color'])
+            train_head = fragments.get(train_key)
+            if train_head is None:
+                train_head = fragments[train_key] = json.dumps({
+                    'destination': train['destination'],
+                    'line': train['line'],
+                    'color': train['color']
+                }).encode()[:-1] + b', "weather": '
+            encoded_trains.append(train_head + weather + b', "estimates": ' + json.dumps(cls.tfl_estimates(train['estimates'])).encode() + b'}')
+        
+        if weather is None:
+            return head + b', '.join(encoded_trains) + b']}'
+        return head + b', '.join(encoded_trains) + b'], "weather": ' + weather + b'}'
+    
+    @classmethod
+    def bart_document(cls, station, station_name, arrivals, fields=None):
+        """The document build_bart_response encodes, as a dict, for MessagePack responses"""
+        return {'root': {
+            'uri': {'#cdata-section': 'http://api.bart.gov/api/etd.aspx?cmd=etd&orig=' + station},
+            'date': time.strftime('%m/%d/%Y'),
+            'time': time.strftime('%I:%M:%S %p'),
+            'station': [{
+                'name': station_name,
+                'abbr': station,
+                'etd': [cls.project_bart_etd(arrival, fields or cls.BART_FIELDS) for arrival in arrivals]
+            }],
+            'message': ''
+        }}
+    
+    @classmethod
+    def tfl_document(cls, station_name, station_id, trains, weather_data, fields=None):
+        """The document build_tfl_response encodes, as a dict, for MessagePack responses"""
+        projected_trains = []
+        for train in trains:
+            projected = {key: train[key] for key in cls.TFL_FIELDS if fields is None or key in fields}
+            if 'estimates' in projected:
+                projected['estimates'] = cls.tfl_estimates(train['estimates'])
+            projected_trains.append(projected)
+        document = {'station': {'name': station_name, 'id': station_id}, 'trains': projected_trains}
+        if fields is None or 'weather' in fields:
+            document['weather'] = weather_data
+        return document
+    
+    @classmethod
+    def bart_options(cls, station, direction):
+        """Every upcoming BART train at station as a ranking option"""
+        arrivals = cls.get_current_arrivals(station, direction=None if direction == 'all' else direction)
+        cls.record_bart_history(station, arrivals)
+        cls.record_departures(station)
+        options = []
+        for arrival in arrivals:
+            weather = arrival['weather']
+            for est in arrival['estimates']:
+                options.append({
+                    'destination': arrival['destination'],
+                    'abbreviation': arrival['abbreviation'],
+                    'color': arrival['color'],
+                    'minutes': est['minutes'],
+                    'platform': est['platform'],
+                    'length': est['length'],
+                    'delay': int(est['delay']),
+                    # Shorter trains are more crowded; 10 cars is BART's longest
+                    'crowding': round(1 - int(est['length']) / 10, 2),
+                    'weather': weather
+                })
+        return cls.format_options(options, cls.bart_minutes_label)
+    
+    @classmethod
+    def tfl_options(cls, station_id, station_info):
+        """Every TfL arrival within 30 minutes at station_id as a ranking option.
+        
+        TfL gives no delay or crowding figures, so those factors are zero.
+        """
+        arrivals_data, age = cls.fetch_tfl_arrivals(station_id)
+        weather = cls.get_weather_data_by_coords(station_info['lat'], station_info['lon'], station_info['name'])
+        trains = cls.group_tfl_arrivals(arrivals_data, weather)
+        if age is None:
+            cls.record_tfl_history(station_id, trains)
+        options = [{
+            'destination': train['destination'],
+            'line': train['line'],
+            'color': train['color'],
+            'minutes': est['minutes'],
+            'platform': est['platform'],
+            'delay': 0,
+            'crowding': 0.0,
+            'weather': weather
+        } for train in trains for est in train['estimates']]
+        return cls.format_options(options, cls.tfl_minutes_label)
+    
+    @classmethod
+    def format_options(cls, options, minutes_label):
+        """Score options and replace their raw inputs with what clients are sent"""
+        for option in options:
+            option['score'] = cls.ranking.score(option)
+            option['minutes'] = minutes_label(option['minutes'])
+            weather = option.pop('weather') or {}
+            option['condition'] = weather.get('condition')
+            option['aqi'] = weather.get('aqi')
+        return options
     
     def handle_bart_api(self, parsed_path):
         """Generate realistic BART data with real weather"""
         try:
             params = parse_qs(parsed_path.query)
             station = params.get('station', ['12TH'])[0]
-            direction = params.get('direction', ['all'])[0]
+            direction = params.get('direction', ['all'])[0].lower()
+            try:
+                fields = self.parse_fields(params, self.BART_FIELDS)
+                limit = self.parse_limit(params)
+                rank = self.parse_limit(params, 'rank')
+            except ValueError as e:
+                self.send_json({'error': str(e)}, status=400)
+                return
             
             station_name = self.STATIONS.get(station, station)
             
-            arrivals = BARTProxyHandler.get_current_arrivals(station)
+            if rank is not None:
+                if BARTProxyHandler.schedule_created_at is None:
+                    BARTProxyHandler.initialize_schedules()
+                # Arrivals change with the schedule epoch as well as the clock
+                snapshot = (BARTProxyHandler.schedule_epoch_seed, BARTProxyHandler.schedule_created_at,
+                            self.ranking.snapshot())
+                ranking = self.ranking.ranked(('bart', station, direction), snapshot,
+                                              lambda: BARTProxyHandler.bart_options(station, direction))
+                self.send_json({'station': {'name': station_name, 'abbr': station}, 'ranked': ranking[:rank]})
+                return
+            
+            arrivals = BARTProxyHandler.get_current_arrivals(
+                station,
+                direction=None if direction == 'all' else direction,
+                include_weather=fields is None or 'weather' in fields,
+                limit=limit
+            )
             
             elapsed = (datetime.now() - BARTProxyHandler.schedule_created_at).total_seconds() / 60
             
-            print(f"\n{'='*60}")
-            print(f"🚇 BART Data Request:")
-            print(f"   Station: {station_name} ({station})")
-            print(f"   Time elapsed: {elapsed:.1f} minutes")
-            print(f"   Destinations: {len(arrivals)}")
-            print(f"{'='*60}")
-            
-            json_result = {
-                'root': {
-                    'uri': {'#cdata-section': 'http://api.bart.gov/api/etd.aspx?cmd=etd&orig=' + station},
-                    'date': time.strftime('%m/%d/%Y'),
-                    'time': time.strftime('%I:%M:%S %p'),
-                    'station': [{
-                        'name': station_name,
-                        'abbr': station,
-                        'etd': []
-                    }],
-                    'message': ''
-                }
-            }
+            self.logger.info('bart.request', sampled=True, station=station_name, station_code=station,
+                             elapsed_minutes=round(elapsed, 1), destinations=len(arrivals))
+            self.record_bart_history(station, arrivals)
+            self.record_departures(station)
+            
+            with self.tracer.span('build_response'):
+                if self.binary:
+                    document = BARTProxyHandler.bart_document(station, station_name, arrivals, fields)
+                else:
+                    body = BARTProxyHandler.build_bart_response(station, station_name, arrivals, fields)
             
             for arrival in arrivals:
-                etd_item = {
-                    'destination': arrival['destination'],
-                    'abbreviation': arrival['abbreviation'],
-                    'limited': '0',
-                    'estimate': [],
-                    'weather': arrival['weather']  # Add weather data
-                }
-                
-                for est in arrival['estimates']:
-                    etd_item['estimate'].append({
-                        'minutes': est['minutes'],
-                        'platform': est['platform'],
-                        'direction': arrival['direction'],
-                        'length': est['length'],
-                        'color': arrival['color'],
-                        'hexcolor': arrival['hexcolor'],
-                        'bikeflag': '1',
-                        'delay': est['delay']
-                    })
-                
-                json_result['root']['station'][0]['etd'].append(etd_item)
-                
-                train_times = [e['minutes'] for e in etd_item['estimate'][:3]]
-                print(f"   → {arrival['destination']}: {', '.join(train_times)} min")
+                self.logger.debug('bart.destination', sampled=True, destination=arrival['destination'],
+                                  minutes=','.join(self.bart_minutes_label(e['minutes']) for e in arrival['estimates'][:3]))
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(json_result).encode())
+            if self.binary:
+                self.send_json(document)
+            else:
+                self.send_body(body)
             
-            print(f"✅ Response sent successfully\n")
+            self.logger.debug('bart.sent', sampled=True, station_code=station)
             
         except Exception as e:
-            print(f"\n❌ Error: {e}")
-            import traceback
-            traceback.print_exc()
+            self.logger.exception('bart.error', error=str(e))
             
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            error_response = json.dumps({'error': str(e)})
-            self.wfile.write(error_response.encode())
+            self.send_json({'error': str(e)}, status=500)
     
     def log_message(self, format, *args):
-        if '/api/bart' not in args[0] and '/api/reset' not in args[0] and '/api/weather' not in args[0] and '/api/tfl' not in args[0]:
+        # args[0] is the request line for access logs, but a status or exception for errors
+        request = str(args[0]) if args else ''
+        if '/api/bart' not in request and '/api/reset' not in request and '/api/weather' not in request and '/api/tfl' not in request and '/api/batch' not in request:
+            return
+        self.logger.debug('http.access', sampled=True, client=self.address_string(), message=format % args)
+
+class CapturedRequest(BARTProxyHandler):
+    """A handler with no socket: runs one /api/batch sub-query and keeps what it would have sent"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.response_status = None
+        self.body = b''
+    
+    def send_body(self, body, status=200, content_type='application/json', headers=None):
+        self.response_status = status
+        self.body = body
+
+
+class SmartCommuteHTTPServer(ThreadingHTTPServer):
+    """Thread-per-request server that counts in-flight requests so shutdown can drain them"""
+    
+    daemon_threads = True
+    # Listen backlog; the default of 5 drops connection bursts, and dropped SYNs
+    # cost clients a one-second retransmit before admission control even sees them
+    request_queue_size = 128
+    
+    def __init__(self, server_address, handler_class, reuse_port=False):
+        self.reuse_port = reuse_port
+        self.active_requests = 0
+        self.active_lock = threading.Lock()
+        # Keep-alive connections waiting for their next request; drain() closes them
+        self.idle_connections = set()
+        self.draining = False
+        ThreadingHTTPServer.__init__(self, server_address, handler_class)
+    
+    def server_bind(self):
+        if self.reuse_port:
+            # Every worker binds its own socket; the kernel spreads connections across them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadingHTTPServer.server_bind(self)
+    
+    def process_request_thread(self, request, client_address):
+        with self.active_lock:
+            self.active_requests += 1
+        try:
+            ThreadingHTTPServer.process_request_thread(self, request, client_address)
+        finally:
+            with self.active_lock:
+                self.active_requests -= 1
+    
+    def mark_idle(self, connection):
+        """Note that a connection is waiting for another request; False if draining"""
+        with self.active_lock:
+            if self.draining:
+                return False
+            self.idle_connections.add(connection)
+            return True
+    
+    def mark_busy(self, connection):
+        with self.active_lock:
+            self.idle_connections.discard(connection)
+    
+    def drain(self, timeout):
+        """Wait for in-flight requests to finish; True if they all did within timeout.
+        
+        Idle keep-alive connections are shut down at once, and busy ones close after
+        their current response.
+        """
+        with self.active_lock:
+            self.draining = True
+            for connection in self.idle_connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+            self.idle_connections.clear()
+        deadline = time.time() + timeout
+        while self.active_requests and time.time() < deadline:
+            time.sleep(0.05)
+        return self.active_requests == 0
+
+
+class PreforkSupervisor:
+    """Fork worker processes that share one port via SO_REUSEPORT, restart any that die
+    and drain them all on shutdown"""
+    
+    def __init__(self, port, workers, handler_class, drain_timeout=10.0, warm_weather=False):
+        self.port = port
+        self.workers = workers
+        self.handler_class = handler_class
+        self.drain_timeout = drain_timeout
+        # Warm up inside the first worker: a thread started before fork could hold
+        # cache or metrics locks that every child would inherit locked
+        self.warm_weather = warm_weather
+        self.children = {}  # pid -> start time
+        self.stopping = False
+        self.logger = handler_class.logger
+    
+    @staticmethod
+    def supported():
+        return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+    
+    def run(self):
+        # Fail fast (in the supervisor) if the port cannot be bound at all
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        probe.bind(('', self.port))
+        probe.close()
+        
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        for index in range(self.workers):
+            self.spawn(warm=self.warm_weather and index == 0)
+        
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if self.stopping or started is None:
+                continue
+            self.logger.warning('worker.exited', pid=pid, status=os.waitstatus_to_exitcode(status))
+            if time.time() - started < 1.0:
+                time.sleep(1.0)  # don't spin if workers crash on start
+            self.spawn()
+        self.logger.info('supervisor.stopped')
+    
+    def request_stop(self, signum, frame):
+        if self.stopping:
+            self.kill_all()
             return
+        self.stopping = True
+        self.logger.info('supervisor.draining', workers=len(self.children), timeout=self.drain_timeout)
+        for pid in list(self.children):
+            self.signal_child(pid, signal.SIGTERM)
+        # Workers that are still alive after the drain window get killed
+        killer = threading.Timer(self.drain_timeout + 5.0, self.kill_all)
+        killer.daemon = True
+        killer.start()
+    
+    def kill_all(self):
+        for pid in list(self.children):
+            self.signal_child(pid, signal.SIGKILL)
+    
+    @staticmethod
+    def signal_child(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+    
+    def spawn(self, warm=False):
+        # Hold off SIGTERM/SIGINT across the fork so neither process runs the supervisor's
+        # handler half set up: the child resets its copy first, the parent records the pid
+        stop_signals = {signal.SIGTERM, signal.SIGINT}
+        signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                self.children = {}
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+                code = 0
+                try:
+                    self.worker_main(warm)
+                except BaseException:
+                    self.logger.exception('worker.crashed', pid=os.getpid())
+                    code = 1
+                finally:
+                    self.handler_class.tracer.close()
+                    self.logger.close()
+                    os._exit(code)
+            self.children[pid] = time.time()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+    
+    def worker_main(self, warm=False):
+        # SIGINT is already ignored (see spawn): Ctrl+C reaches the whole process group,
+        # so the supervisor coordinates shutdown
+        httpd = SmartCommuteHTTPServer(('', self.port), self.handler_class, reuse_port=True)
+        
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever, so it must run on another thread
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+        
+        signal.signal(signal.SIGTERM, stop)
+        self.logger.info('worker.started', pid=os.getpid())
+        if warm:
+            threading.Thread(target=self.handler_class.warm_weather, name='warm-weather', daemon=True).start()
+        httpd.serve_forever()
+        httpd.server_close()  # stop accepting, then let in-flight requests finish
+        drained = httpd.drain(self.drain_timeout)
+        self.handler_class.tape.close()
+        self.handler_class.persistent_cache.close()
+        self.logger.info('worker.stopped', pid=os.getpid(), drained=drained)
+
+
+def parse_rate_limit(text):
+    """'upstream=2,10' -> ('upstream', (2.0, 10.0)): 2 requests a second, bursts of up to 10"""
+    try:
+        endpoint_class, spec = text.split('=', 1)
+        rate, burst = (float(part) for part in spec.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected CLASS=RATE,BURST, got {text!r}")
+    if rate <= 0 or burst < 1:
+        raise argparse.ArgumentTypeError('rate must be positive and burst at least 1')
+    return endpoint_class.strip(), (rate, burst)
+
+
+def parse_upstream_budget(text):
+    """'tfl=50,0' -> ('tfl', (50, 0)): 50 calls a minute, no daily cap"""
+    try:
+        upstream, spec = text.split('=', 1)
+        per_minute, per_day = (int(part) for part in spec.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected UPSTREAM=PER_MINUTE,PER_DAY, got {text!r}")
+    upstream = upstream.strip()
+    if upstream not in UpstreamBudget.UPSTREAMS:
+        raise argparse.ArgumentTypeError(f"upstream must be one of {', '.join(UpstreamBudget.UPSTREAMS)}")
+    return upstream, (per_minute, per_day)
 
-def run_server(port=8000):
+
+def parse_rank_weight(text):
+    """'crowding=10' -> ('crowding', 10.0): a fully crowded train costs as much as 10 minutes' wait"""
+    try:
+        factor, weight = text.split('=', 1)
+        weight = float(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected FACTOR=WEIGHT, got {text!r}")
+    factor = factor.strip()
+    if factor not in RankingEngine.WEIGHTS:
+        raise argparse.ArgumentTypeError(f"factor must be one of {', '.join(RankingEngine.WEIGHTS)}")
+    return factor, weight
+
+
+def run_server(port=8000, trace_sample_rate=0.0, trace_file=None,
+               log_level='INFO', log_format='text', log_sample_rate=1.0,
+               open_meteo_url=None, air_quality_url=None, tfl_url=None,
+               record_file=None, replay_file=None, replay_timing=False, seed=None,
+               workers=1, drain_timeout=10.0, cache_file=None, rate_limits=None, api_keys=None,
+               max_active=0, max_queue=64, max_queue_wait=2.0, upstream_budgets=None, warm_weather=False,
+               history_resolution=60, history_slots=1440, reliability_window=3600, on_time_minutes=1,
+               rank_weights=None, rank_snapshot=10, stations_file=None, keepalive_timeout=15,
+               keepalive_requests=100):
     try:
         os.chdir(os.path.dirname(os.path.abspath(__file__)))
     except:
         pass
     
+    BARTProxyHandler.logger.configure(level=log_level, fmt=log_format, sample_rate=log_sample_rate)
+    BARTProxyHandler.tracer.configure(sample_rate=trace_sample_rate, path=trace_file)
+    if open_meteo_url:
+        BARTProxyHandler.OPEN_METEO_URL = open_meteo_url
+    if air_quality_url:
+        BARTProxyHandler.AIR_QUALITY_URL = air_quality_url
+    if tfl_url:
+        BARTProxyHandler.TFL_BASE_URL = tfl_url.rstrip('/')
+    BARTProxyHandler.tape.configure(record_path=record_file, replay_path=replay_file, replay_timing=replay_timing)
+    if BARTProxyHandler.tape.corrupt:
+        BARTProxyHandler.logger.warning('replay.corrupt', path=replay_file, error=BARTProxyHandler.tape.corrupt,
+                                        entries=sum(len(entries) for entries in BARTProxyHandler.tape.responses.values()))
+    BARTProxyHandler.rate_limiter.configure(rate_limits, api_keys=api_keys)
+    BARTProxyHandler.budget.configure(upstream_budgets)
+    BARTProxyHandler.admission.configure(max_active=max_active, max_queue=max_queue, max_wait=max_queue_wait)
+    BARTProxyHandler.history.configure(resolution=history_resolution, slots=history_slots)
+    BARTProxyHandler.reliability.configure(window=reliability_window, on_time_minutes=on_time_minutes)
+    BARTProxyHandler.ranking.configure(weights=rank_weights, snapshot_seconds=rank_snapshot)
+    if keepalive_timeout > 0 and keepalive_requests > 1:
+        BARTProxyHandler.timeout = keepalive_timeout
+        BARTProxyHandler.max_keepalive_requests = keepalive_requests
+    else:
+        # Answer every request with Connection: close, as an HTTP/1.0 server would
+        BARTProxyHandler.timeout = None
+        BARTProxyHandler.max_keepalive_requests = 1
+    if seed is not None:
+        BARTProxyHandler.schedule_seed = seed
+        random.seed(seed)
+    if workers > 1 and not PreforkSupervisor.supported():
+        BARTProxyHandler.logger.warning('prefork.unsupported', reason='needs os.fork and SO_REUSEPORT')
+        workers = 1
+    if workers > 1:
+        BARTProxyHandler.shared_schedule_epoch = multiprocessing.RawValue('d', 0.0)
+        BARTProxyHandler.shared_reset_count = multiprocessing.RawValue('Q', 0)
+        BARTProxyHandler.shared_weather = SharedWeatherCache()
+    if cache_file:
+        BARTProxyHandler.persistent_cache.configure(cache_file)
+        BARTProxyHandler.load_persistent_cache()
     BARTProxyHandler.initialize_schedules()
-    
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, BARTProxyHandler)
+    BARTProxyHandler.get_network()
+    BARTProxyHandler.stations_file = stations_file
+    BARTProxyHandler.get_station_indexes()
+    BARTProxyHandler.get_name_indexes()
+    if warm_weather and workers == 1:
+        threading.Thread(target=BARTProxyHandler.warm_weather, name='warm-weather', daemon=True).start()
     
     print(f"""
 ╔═══════════════════════════════════════════════════════════╗
 ║  🚇 SmartCommute - Real Data from Multiple APIs!         ║
 ╠═══════════════════════════════════════════════════════════╣
 ║  Server: http://localhost:{port}                            ║
+║  Workers: {workers:<3}                                             ║
 ║  Open:   smartcommute_v2.html                             ║
 ╠═══════════════════════════════════════════════════════════╣
 ║  ✓ BART: Real-time arrivals + weather                     ║
@@ -996,20 +4174,118 @@ def run_server(port=8000):
 ╠═══════════════════════════════════════════════════════════╣
 ║  Endpoints:                                               ║
 ║    /api/bart?station=SBRN                                 ║
+║    /api/bart?station=SBRN&rank=3                          ║
 ║    /api/tfl?station=940GZZLUKSX                           ║
 ║    /api/tfl-status                                        ║
 ║    /api/weather?city=London&days=7                        ║
+║    /api/batch?q=<path>&q=<path>                           ║
+║    /api/history?metric=temperature&key=12TH               ║
+║    /api/reliability?scope=line                            ║
+║    /api/route?from=12TH&to=SFIA                           ║
+║    /api/nearest?lat=37.80&lon=-122.27&k=5                 ║
+║    /api/autocomplete?q=oak                                ║
 ║    /api/reset                                             ║
+║    /metrics                                               ║
+║    /debug/traces?limit=20                                 ║
 ╠═══════════════════════════════════════════════════════════╣
 ║  Press Ctrl+C to stop                                     ║
 ╚═══════════════════════════════════════════════════════════╝
     """)
     
+    if workers > 1:
+        try:
+            PreforkSupervisor(port, workers, BARTProxyHandler, drain_timeout, warm_weather).run()
+            print("\n\n👋 Server stopped. Goodbye!")
+        finally:
+            BARTProxyHandler.tape.close()
+            BARTProxyHandler.persistent_cache.close()
+            BARTProxyHandler.tracer.close()
+            BARTProxyHandler.logger.close()
+        return
+    
+    httpd = SmartCommuteHTTPServer(('', port), BARTProxyHandler)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\n\n👋 Server stopped. Goodbye!")
         httpd.shutdown()
+    finally:
+        BARTProxyHandler.tape.close()
+        BARTProxyHandler.persistent_cache.close()
+        BARTProxyHandler.tracer.close()
+        BARTProxyHandler.logger.close()
 
 if __name__ == '__main__':
-    run_server()
+    parser = argparse.ArgumentParser(description='SmartCommute backend server')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--trace-sample', type=float, default=0.0,
+                        help='fraction of API requests to trace (0 disables tracing)')
+    parser.add_argument('--trace-file', default=None,
+                        help='also append finished traces to this JSONL file')
+    parser.add_argument('--log-level', default='INFO', choices=sorted(StructuredLogger.LEVELS))
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'])
+    parser.add_argument('--log-sample', type=float, default=1.0,
+                        help='fraction of requests whose per-request lines are logged')
+    parser.add_argument('--open-meteo-url', default=None, help='override the Open-Meteo forecast endpoint')
+    parser.add_argument('--air-quality-url', default=None, help='override the Open-Meteo air-quality endpoint')
+    parser.add_argument('--tfl-url', default=None, help='override the TfL API base URL')
+    parser.add_argument('--record', default=None, help='append every upstream response to this log (.gz to compress)')
+    parser.add_argument('--replay', default=None, help='serve upstream calls from a recorded log instead of the network')
+    parser.add_argument('--replay-timing', action='store_true', help='sleep for each call\'s recorded latency on replay')
+    parser.add_argument('--seed', type=int, default=None, help='seed the simulated schedules for repeatable runs')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='pre-fork this many worker processes sharing the port (SO_REUSEPORT)')
+    parser.add_argument('--drain-timeout', type=float, default=10.0,
+                        help='seconds a worker may spend finishing in-flight requests on shutdown')
+    parser.add_argument('--cache-file', default=None,
+                        help='keep weather, forecasts and line status in this SQLite file across restarts')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[],
+                        metavar='CLASS=RATE,BURST',
+                        help='per-client token bucket for an endpoint class (upstream, simulated, admin), '
+                             'e.g. upstream=2,10; repeatable')
+    parser.add_argument('--api-key', action='append', default=[],
+                        help='X-API-Key value that is rate limited on its own rather than by IP; repeatable')
+    parser.add_argument('--max-active', type=int, default=0,
+                        help='requests handled at once per worker before new ones queue (0 disables admission control)')
+    parser.add_argument('--max-queue', type=int, default=64, help='requests allowed to wait for admission')
+    parser.add_argument('--max-queue-wait', type=float, default=2.0,
+                        help='seconds a request may wait for admission before getting a 503')
+    parser.add_argument('--upstream-budget', type=parse_upstream_budget, action='append', default=[],
+                        metavar='UPSTREAM=PER_MINUTE,PER_DAY',
+                        help='cap calls to open-meteo or tfl, e.g. open-meteo=600,10000 (0 = no cap); repeatable')
+    parser.add_argument('--warm-weather', action='store_true',
+                        help='fetch weather for all BART destinations in the background at startup')
+    parser.add_argument('--history-resolution', type=float, default=60,
+                        help='seconds per bucket in the /api/history time series')
+    parser.add_argument('--history-slots', type=int, default=1440,
+                        help='buckets kept per time series (0 disables history)')
+    parser.add_argument('--reliability-window', type=float, default=3600,
+                        help='seconds of departures /api/reliability summarizes')
+    parser.add_argument('--on-time-minutes', type=float, default=1,
+                        help='a departure delayed by less than this many minutes counts as on time')
+    parser.add_argument('--rank-weight', type=parse_rank_weight, action='append', default=[],
+                        metavar='FACTOR=WEIGHT',
+                        help='minutes of waiting a full penalty is worth when ranking (arrival, delay, crowding, '
+                             'weather, aqi), e.g. crowding=10; repeatable')
+    parser.add_argument('--rank-snapshot', type=float, default=10,
+                        help='seconds a rank= result is reused before it is recomputed')
+    parser.add_argument('--stations-file', default=None,
+                        help='CSV of extra stations (network, code, name, lat, lon) for /api/nearest')
+    parser.add_argument('--keepalive-timeout', type=float, default=15,
+                        help='seconds a client connection may sit idle before it is closed (0 disables keep-alive)')
+    parser.add_argument('--keepalive-requests', type=int, default=100,
+                        help='requests served on one connection before it is closed')
+    args = parser.parse_args()
+    
+    run_server(args.port, trace_sample_rate=args.trace_sample, trace_file=args.trace_file,
+               log_level=args.log_level, log_format=args.log_format, log_sample_rate=args.log_sample,
+               open_meteo_url=args.open_meteo_url, air_quality_url=args.air_quality_url, tfl_url=args.tfl_url,
+               record_file=args.record, replay_file=args.replay, replay_timing=args.replay_timing, seed=args.seed,
+               workers=args.workers, drain_timeout=args.drain_timeout, cache_file=args.cache_file,
+               rate_limits=dict(args.rate_limit), api_keys=args.api_key, max_active=args.max_active, max_queue=args.max_queue,
+               max_queue_wait=args.max_queue_wait, upstream_budgets=dict(args.upstream_budget),
+               warm_weather=args.warm_weather, history_resolution=args.history_resolution,
+               history_slots=args.history_slots, reliability_window=args.reliability_window,
+               on_time_minutes=args.on_time_minutes, rank_weights=dict(args.rank_weight),
+               rank_snapshot=args.rank_snapshot, stations_file=args.stations_file,
+               keepalive_timeout=args.keepalive_timeout, keepalive_requests=args.keepalive_requests)
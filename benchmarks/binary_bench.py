@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Size and throughput of MessagePack responses against JSON, fully offline.
+
+Builds the /api/bart, /api/tfl and /api/tfl-status responses in-process the
+way the handlers do (the weather cache is pre-filled and TfL data comes from
+the stand-in payload generators), then reports each one's size in both
+formats and how long building and decoding take:
+
+    python benchmarks/binary_bench.py
+    python benchmarks/binary_bench.py --json binary.json
+"""
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import sys
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from backend_v2 import BARTProxyHandler, MessagePackCodec  # noqa: E402
+from micro_bench import measure, prime_weather_cache  # noqa: E402
+from standins import arrivals_payload, line_status_payload  # noqa: E402
+
+TFL_ARRIVAL_COUNTS = (24, 200)
+
+
+def bart_builders(station):
+    """(JSON body builder, document builder) for a station's /api/bart response"""
+    name = BARTProxyHandler.STATIONS[station]
+    arrivals = BARTProxyHandler.get_current_arrivals(station)
+    return (lambda: BARTProxyHandler.build_bart_response(station, name, arrivals),
+            lambda: BARTProxyHandler.bart_document(station, name, arrivals))
+
+
+def tfl_builders(station_id, count):
+    """(JSON body builder, document builder) for /api/tfl with `count` stand-in arrivals"""
+    weather = BARTProxyHandler.get_fallback_weather()
+    trains = BARTProxyHandler.group_tfl_arrivals(arrivals_payload(station_id, count), weather)
+    return (lambda: BARTProxyHandler.build_tfl_response('Stand-in Station', station_id, trains, 'stand-in', weather),
+            lambda: BARTProxyHandler.tfl_document('Stand-in Station', station_id, trains, weather))
+
+
+def tfl_status_document():
+    """The /api/tfl-status document for the stand-in line statuses"""
+    lines = []
+    for line in line_status_payload():
+        status = line['lineStatuses'][0]
+        lines.append({
+            'id': line['id'],
+            'name': line['name'],
+            'color': BARTProxyHandler.get_tube_line_color(line['name']),
+            'severity': status['statusSeverity'],
+            'status': status.get('reason', status['statusSeverityDescription'])
+        })
+    return {'lines': lines}
+
+
+def responses():
+    """Yield (name, JSON body builder, document builder) for every response being compared"""
+    yield ('bart[12TH]',) + bart_builders('12TH')
+    for count in TFL_ARRIVAL_COUNTS:
+        yield (f"tfl[arrivals={count}]",) + tfl_builders('940GZZLUKSX', count)
+    yield 'tfl-status', lambda: json.dumps(tfl_status_document()).encode(), tfl_status_document
+
+
+def compare_formats(build_json, build_document, repeat):
+    """Sizes (raw and deflated), and build/decode timings for JSON and MessagePack bodies.
+    
+    Building includes the handler's own work: fragment splicing for JSON, the
+    document dict plus the encoder for MessagePack.
+    """
+    json_body = build_json()
+    msgpack_body = MessagePackCodec.encode(build_document())
+    return {
+        'json_bytes': len(json_body),
+        'msgpack_bytes': len(msgpack_body),
+        'json_deflated_bytes': len(zlib.compress(json_body)),
+        'msgpack_deflated_bytes': len(zlib.compress(msgpack_body)),
+        'json_encode': measure(build_json, repeat),
+        'msgpack_encode': measure(lambda: MessagePackCodec.encode(build_document()), repeat),
+        'json_decode': measure(lambda: json.loads(json_body), repeat),
+        'msgpack_decode': measure(lambda: MessagePackCodec.decode(msgpack_body), repeat)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SmartCommute JSON vs MessagePack comparison')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', default=None, help='write results to this file')
+    args = parser.parse_args()
+
+    BARTProxyHandler.logger.configure(level='ERROR')
+    BARTProxyHandler.initialize_schedules()
+    prime_weather_cache()
+
+    results = {}
+    print(f"{'document':<22}{'json B':>9}{'msgpack B':>11}{'ratio':>7}"
+          f"{'json enc us':>13}{'mp enc us':>11}{'json dec us':>13}{'mp dec us':>11}")
+    for name, build_json, build_document in responses():
+        row = results[name] = compare_formats(build_json, build_document, args.repeat)
+        print(f"{name:<22}{row['json_bytes']:>9,}{row['msgpack_bytes']:>11,}"
+              f"{row['msgpack_bytes'] / row['json_bytes']:>7.2f}"
+              f"{row['json_encode']['ns_per_op_min'] / 1000:>13.1f}{row['msgpack_encode']['ns_per_op_min'] / 1000:>11.1f}"
+              f"{row['json_decode']['ns_per_op_min'] / 1000:>13.1f}{row['msgpack_decode']['ns_per_op_min'] / 1000:>11.1f}")
+
+    if args.json:
+        report = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results
+        }
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""End-to-end load test for the SmartCommute server, fully offline.
+
+Starts the Open-Meteo/TfL stand-ins, launches backend_v2.py against them and
+drives each endpoint at a set of concurrency levels with a closed-loop load
+generator, reporting throughput and p50/p95/p99 latency:
+
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --endpoints bart,tfl --concurrency 1,8,32 --duration 15
+    python benchmarks/load_test.py --upstream-latency-ms 120 --upstream-error-rate 0.05 --json results.json
+
+Pass --server to drive an already-running server instead (its upstreams are
+then whatever that server was started with).
+"""
+from urllib.parse import urlparse
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from backend_v2 import BARTProxyHandler  # noqa: E402
+from standins import start_standins, backend_args  # noqa: E402
+
+
+def endpoint_paths():
+    """Request paths per endpoint; each worker cycles through its endpoint's list"""
+    return {
+        'bart': [f"/api/bart?station={code}" for code in BARTProxyHandler.STATIONS],
+        'tfl': [f"/api/tfl?station={station_id}" for station_id in BARTProxyHandler.LONDON_STATIONS],
+        'tfl-status': ['/api/tfl-status'],
+        'weather': [f"/api/weather?city={city.replace(' ', '%20')}&days=7" for city in BARTProxyHandler.CITY_COORDS]
+    }
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_load(host, port, paths, concurrency, duration, warmup=1.0, timeout=30):
+    """Closed-loop load: `concurrency` workers each send a request as soon as the last one completes"""
+    latencies = []
+    statuses = {}
+    errors = [0]
+    lock = threading.Lock()
+    start_gate = threading.Barrier(concurrency + 1)
+    measure_from = [0.0]
+    stop_at = [0.0]
+
+    def worker(offset):
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        local_latencies = []
+        local_statuses = {}
+        local_errors = 0
+        i = offset
+        start_gate.wait()
+        while True:
+            started = time.perf_counter()
+            if started >= stop_at[0]:
+                break
+            path = paths[i % len(paths)]
+            i += 1
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=timeout)
+                status = None
+            ended = time.perf_counter()
+            if started < measure_from[0]:
+                continue
+            if status is None or status >= 500:
+                local_errors += 1
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+            local_latencies.append(ended - started)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    now = time.perf_counter()
+    measure_from[0] = now + warmup
+    stop_at[0] = now + warmup + duration
+    start_gate.wait()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))},
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round((latencies[-1] if latencies else 0.0) * 1000, 2)
+    }
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_backend(port, extra_args, wait=15.0):
+    """Launch backend_v2.py in a subprocess and wait until it accepts connections"""
+    command = [sys.executable, os.path.join(ROOT, 'backend_v2.py'), '--port', str(port),
+               '--log-level', 'WARNING'] + extra_args
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"backend exited with code {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('backend did not start listening in time')
+
+
+def format_table(results):
+    header = f"{'endpoint':<12}{'conc':>6}{'reqs':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    lines = [header, '-' * len(header)]
+    for row in results:
+        lines.append(f"{row['endpoint']:<12}{row['concurrency']:>6}{row['requests']:>8}{row['errors']:>8}"
+                     f"{row['throughput_rps']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SmartCommute end-to-end load test')
+    parser.add_argument('--endpoints', default='bart,tfl,tfl-status,weather')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=10.0, help='measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=1.0, help='unmeasured seconds before each run')
+    parser.add_argument('--server', default=None, help='drive an existing server, e.g. http://localhost:8000')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='extra flag passed to backend_v2.py (repeatable)')
+    parser.add_argument('--upstream-latency-ms', type=float, default=50.0)
+    parser.add_argument('--upstream-jitter-ms', type=float, default=10.0)
+    parser.add_argument('--upstream-error-rate', type=float, default=0.0)
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    paths = endpoint_paths()
+    endpoints = [name.strip() for name in args.endpoints.split(',') if name.strip()]
+    unknown = [name for name in endpoints if name not in paths]
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    backend = None
+    standins = None
+    if args.server:
+        target = urlparse(args.server)
+        host, port = target.hostname, target.port or 80
+    else:
+        standins, base_url = start_standins(latency_ms=args.upstream_latency_ms,
+                                            jitter_ms=args.upstream_jitter_ms,
+                                            error_rate=args.upstream_error_rate)
+        host, port = '127.0.0.1', free_port()
+        backend = start_backend(port, backend_args(base_url) + args.server_arg)
+
+    results = []
+    try:
+        for endpoint in endpoints:
+            for level in levels:
+                row = run_load(host, port, paths[endpoint], level, args.duration, args.warmup)
+                row['endpoint'] = endpoint
+                results.append(row)
+                print(f"  {endpoint} x{level}: {row['throughput_rps']} req/s, p99 {row['p99_ms']} ms", file=sys.stderr)
+    finally:
+        if backend:
+            backend.terminate()
+            backend.wait()
+        if standins:
+            standins.shutdown()
+
+    print(format_table(results))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump({'config': vars(args), 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the pure computation routines on BARTProxyHandler.
+
+Every benchmark runs offline: the weather cache is pre-filled so
+get_current_arrivals never calls upstream, and TfL arrivals come from the
+stand-in payload generator.
+
+    python benchmarks/micro_bench.py --json current.json
+    python benchmarks/micro_bench.py --baseline baseline.json --threshold 0.10
+    python benchmarks/micro_bench.py --filter arrivals
+
+With --baseline, benchmarks whose best time per call grew by more than
+--threshold (a fraction) are reported as regressions and the exit status is 1.
+"""
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from backend_v2 import BARTProxyHandler, PrefixIndex, StationIndex  # noqa: E402
+from standins import arrivals_payload  # noqa: E402
+
+STATION_COUNTS = (46, 1000, 10000)
+UPTIMES_MINUTES = (0, 60, 24 * 60)
+TFL_ARRIVAL_COUNTS = (24, 200, 1000)
+CATALOGUE_SIZES = (100, 10000, 100000)
+
+
+def synthetic_stations(count):
+    """The real STATIONS table padded with made-up codes up to `count` entries"""
+    stations = dict(BARTProxyHandler.STATIONS)
+    n = 0
+    while len(stations) < count:
+        stations[f"X{n:05d}"] = f"Synthetic Station {n}"
+        n += 1
+    return stations
+
+
+def synthetic_catalogue(count):
+    """The built-in stations plus random stops around the Bay Area and London, `count` in all"""
+    stations = BARTProxyHandler.station_catalogue()
+    rng = random.Random(0)
+    while len(stations) < count:
+        lat, lon = rng.choice(((37.8, -122.3), (51.5, -0.12)))
+        stations.append({'network': 'synthetic', 'code': f"S{len(stations)}", 'name': f"Stop {len(stations)} Road",
+                         'lat': lat + rng.uniform(-0.5, 0.5), 'lon': lon + rng.uniform(-0.5, 0.5)})
+    return stations
+
+
+def prime_weather_cache():
+    """Fill the weather cache for every destination so lookups are always hits"""
+    never_stale = datetime.now() + timedelta(days=365)
+    codes = {dest[1] for destinations in BARTProxyHandler.DESTINATIONS.values() for dest in destinations}
+    for code in codes:
+        weather = BARTProxyHandler.get_fallback_weather()
+        BARTProxyHandler.weather_cache[code] = weather
+        BARTProxyHandler.weather_cache_json[code] = json.dumps(weather).encode()
+        BARTProxyHandler.weather_cache_time[code] = never_stale
+
+
+class StationTable:
+    """Temporarily swap BARTProxyHandler.STATIONS for a table of a given size"""
+
+    def __init__(self, count):
+        self.stations = synthetic_stations(count)
+
+    def __enter__(self):
+        self.original = BARTProxyHandler.STATIONS
+        BARTProxyHandler.STATIONS = self.stations
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        BARTProxyHandler.STATIONS = self.original
+        return False
+
+
+def benchmarks():
+    """Yield (name, setup, func); setup runs once before timing and may return a teardown"""
+    aqi_values = [10, 75, 125, 175, 250, 400]
+    yield 'map_aqi', None, lambda: [BARTProxyHandler.map_aqi(value) for value in aqi_values]
+
+    weather_codes = [0, 1, 3, 45, 53, 63, 73, 81, 95, 42]
+    yield 'map_weather_code', None, lambda: [BARTProxyHandler.map_weather_code(code) for code in weather_codes]
+
+    pm25_values = [4.0, 20.0, 45.0, 100.0, 200.0]
+    yield 'pm25_to_aqi', None, lambda: [BARTProxyHandler.pm25_to_aqi(value) for value in pm25_values]
+
+    for count in STATION_COUNTS:
+        table = StationTable(count)
+
+        def setup(table=table):
+            table.__enter__()
+            return lambda: table.__exit__(None, None, None)
+
+        yield f"initialize_schedules[stations={count}]", setup, BARTProxyHandler.initialize_schedules
+
+    def build_station_schedule():
+        BARTProxyHandler.train_schedules.pop('12TH', None)
+        return BARTProxyHandler.station_schedule('12TH')
+
+    yield 'station_schedule[cold]', BARTProxyHandler.initialize_schedules, build_station_schedule
+
+    for count in STATION_COUNTS:
+        for uptime in UPTIMES_MINUTES:
+            table = StationTable(count)
+
+            def setup(table=table, uptime=uptime):
+                table.__enter__()
+                random.seed(0)
+                BARTProxyHandler.initialize_schedules()
+                BARTProxyHandler.schedule_created_at = datetime.now() - timedelta(minutes=uptime)
+                prime_weather_cache()
+                return lambda: table.__exit__(None, None, None)
+
+            yield (f"get_current_arrivals[stations={count},uptime={uptime}m]", setup,
+                   lambda: BARTProxyHandler.get_current_arrivals('12TH'))
+
+    for count in CATALOGUE_SIZES:
+        built = {}
+
+        def setup(count=count, built=built):
+            built['index'] = StationIndex(synthetic_catalogue(count))
+
+        yield (f"nearest[stations={count},k=5]", setup,
+               lambda built=built: built['index'].nearest(37.8034, -122.2711, 5))
+
+    for count in CATALOGUE_SIZES:
+        built = {}
+
+        def setup(count=count, built=built):
+            built['index'] = PrefixIndex(synthetic_catalogue(count))
+
+        yield (f"autocomplete[names={count}]", setup,
+               lambda built=built: built['index'].search('Oak', 10))
+
+    weather = BARTProxyHandler.get_fallback_weather()
+    for count in TFL_ARRIVAL_COUNTS:
+        arrivals = arrivals_payload('940GZZLUKSX', count)
+        yield (f"group_tfl_arrivals[arrivals={count}]", None,
+               lambda arrivals=arrivals: BARTProxyHandler.group_tfl_arrivals(arrivals, weather))
+
+
+def measure(func, repeat):
+    """Median and best time per call in nanoseconds"""
+    timer = timeit.Timer(func)
+    loops, _ = timer.autorange()
+    samples = [elapsed / loops * 1e9 for elapsed in timer.repeat(repeat=repeat, number=loops)]
+    return {
+        'ns_per_op_median': round(statistics.median(samples), 1),
+        'ns_per_op_min': round(min(samples), 1),
+        'loops': loops,
+        'repeat': repeat
+    }
+
+
+def compare(results, baseline, threshold):
+    """Rows of (name, baseline_ns, current_ns, change, regressed) for benchmarks in both runs"""
+    rows = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        # The fastest repeat is the least disturbed by other load on the machine
+        before = previous['ns_per_op_min']
+        after = current['ns_per_op_min']
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SmartCommute micro-benchmarks')
+    parser.add_argument('--filter', default=None, help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', default=None, help='write results to this file')
+    parser.add_argument('--baseline', default=None, help='results file from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown before a benchmark counts as a regression (0.10 = 10%%)')
+    args = parser.parse_args()
+
+    # Keep schedule logging out of the timings
+    BARTProxyHandler.logger.configure(level='ERROR')
+
+    results = {}
+    for name, setup, func in benchmarks():
+        if args.filter and args.filter not in name:
+            continue
+        teardown = setup() if setup else None
+        try:
+            results[name] = measure(func, args.repeat)
+        finally:
+            if teardown:
+                teardown()
+        print(f"{name:<55}{results[name]['ns_per_op_min']:>16,.0f} ns/op", file=sys.stderr)
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as source:
+        baseline = json.load(source)['results']
+    rows = compare(results, baseline, args.threshold)
+    print(f"{'benchmark':<55}{'baseline ns':>14}{'current ns':>14}{'change':>9}")
+    for name, before, after, change, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        print(f"{name:<55}{before:>14,.0f}{after:>14,.0f}{change:>+9.1%}{flag}")
+    regressions = [row for row in rows if row[4]]
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Local stand-ins for the Open-Meteo and TfL APIs, for offline benchmarking.
+
+One server answers all four upstream APIs the SmartCommute backend calls:
+
+    /v1/forecast                  Open-Meteo forecast (current + optional daily)
+    /v1/air-quality               Open-Meteo air quality (us_aqi, pm10, pm2_5)
+    /StopPoint/<id>/Arrivals      TfL arrivals
+    /Line/Mode/tube/Status        TfL line status
+
+Payloads are synthetic but deterministic per location/station, and every
+response can be delayed and/or failed to mimic a slow or flaky upstream.
+
+    python benchmarks/standins.py --port 9100 --latency-ms 80 --jitter-ms 20 --error-rate 0.02
+    python backend_v2.py --open-meteo-url http://127.0.0.1:9100/v1/forecast \\
+        --air-quality-url http://127.0.0.1:9100/v1/air-quality --tfl-url http://127.0.0.1:9100
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+
+
+TUBE_LINES = [
+    ('bakerloo', 'Bakerloo'), ('central', 'Central'), ('circle', 'Circle'),
+    ('district', 'District'), ('hammersmith-city', 'Hammersmith & City'),
+    ('jubilee', 'Jubilee'), ('metropolitan', 'Metropolitan'), ('northern', 'Northern'),
+    ('piccadilly', 'Piccadilly'), ('victoria', 'Victoria'), ('waterloo-city', 'Waterloo & City')
+]
+
+TUBE_DESTINATIONS = [
+    'Brixton Underground Station', 'Walthamstow Central Underground Station',
+    'Morden Underground Station', 'Edgware Underground Station', 'Ealing Broadway Underground Station',
+    'Epping Underground Station', 'Cockfosters Underground Station', 'Heathrow Terminal 5 Underground Station',
+    'Stratford Underground Station', 'Stanmore Underground Station'
+]
+
+WEATHER_CODES = [0, 1, 2, 3, 45, 51, 61, 63, 71, 80, 95]
+
+
+class StandinConfig:
+    """Latency and failure injection shared by every stand-in endpoint"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error_status=503,
+                 arrivals_per_station=24, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.arrivals_per_station = arrivals_per_station
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def delay(self):
+        if self.latency_ms <= 0 and self.jitter_ms <= 0:
+            return 0.0
+        with self.lock:
+            jitter = self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+    def should_fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def count(self, api):
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+
+
+def seeded_rng(*parts):
+    """A Random whose sequence depends only on the request's identifying parts"""
+    return random.Random(zlib.crc32('|'.join(str(part) for part in parts).encode()))
+
+
+def forecast_payload(params):
+    lat = params.get('latitude', ['0'])[0]
+    lon = params.get('longitude', ['0'])[0]
+    rng = seeded_rng('forecast', lat, lon)
+    payload = {
+        'latitude': float(lat),
+        'longitude': float(lon),
+        'current': {
+            'time': datetime.now().strftime('%Y-%m-%dT%H:%M'),
+            'interval': 900,
+            'temperature_2m': round(rng.uniform(-5, 35), 1),
+            'relative_humidity_2m': rng.randint(20, 100),
+            'weather_code': rng.choice(WEATHER_CODES),
+            'wind_speed_10m': round(rng.uniform(0, 40), 1),
+            'surface_pressure': round(rng.uniform(990, 1030), 1),
+            'visibility': rng.choice([2000, 8000, 16000, 24140])
+        }
+    }
+    if 'daily' in params:
+        days = int(params.get('forecast_days', ['7'])[0])
+        today = datetime.now().date()
+        highs = [round(rng.uniform(5, 35), 1) for _ in range(days)]
+        payload['daily'] = {
+            'time': [(today + timedelta(days=i)).isoformat() for i in range(days)],
+            'temperature_2m_max': highs,
+            'temperature_2m_min': [round(high - rng.uniform(3, 12), 1) for high in highs],
+            'weather_code': [rng.choice(WEATHER_CODES) for _ in range(days)],
+            'precipitation_probability_max': [rng.randint(0, 100) for _ in range(days)],
+            'wind_speed_10m_max': [round(rng.uniform(5, 60), 1) for _ in range(days)]
+        }
+    return payload
+
+
+def air_quality_payload(params):
+    lat = params.get('latitude', ['0'])[0]
+    lon = params.get('longitude', ['0'])[0]
+    rng = seeded_rng('aqi', lat, lon)
+    pm25 = round(rng.uniform(1, 80), 1)
+    return {
+        'latitude': float(lat),
+        'longitude': float(lon),
+        'current': {
+            'us_aqi': rng.choice([None, 0, rng.randint(10, 180)]),
+            'pm10': round(pm25 * rng.uniform(1.1, 2.0), 1),
+            'pm2_5': pm25
+        }
+    }
+
+
+def arrivals_payload(station_id, count):
+    rng = seeded_rng('arrivals', station_id)
+    # Drift predictions with the wall clock so repeated polls look live
+    drift = int(time.time()) % 60
+    arrivals = []
+    for i in range(count):
+        line_id, line_name = rng.choice(TUBE_LINES)
+        destination = rng.choice(TUBE_DESTINATIONS)
+        platform = rng.randint(1, 6)
+        arrivals.append({
+            'id': f"{station_id}-{i}",
+            'vehicleId': str(rng.randint(100, 999)),
+            'naptanId': station_id,
+            'lineId': line_id,
+            'lineName': line_name,
+            'platformName': f"{rng.choice(['Northbound', 'Southbound', 'Eastbound', 'Westbound'])} - Platform {platform}",
+            'destinationName': destination,
+            'towards': destination.replace(' Underground Station', ''),
+            'timeToStation': max(0, rng.randint(0, 1800) - drift),
+            'currentLocation': rng.choice(['At Platform', 'Approaching', 'Between stations', '']),
+            'modeName': 'tube'
+        })
+    return arrivals
+
+
+def line_status_payload():
+    # Vary by minute so caches see realistic churn
+    rng = seeded_rng('status', int(time.time() // 60))
+    lines = []
+    for line_id, line_name in TUBE_LINES:
+        severity = rng.choice([10, 10, 10, 10, 9, 6, 5])
+        status = {'statusSeverity': severity,
+                  'statusSeverityDescription': 'Good Service' if severity == 10 else 'Minor Delays'}
+        if severity != 10:
+            status['reason'] = f"{line_name} Line: Minor delays due to an earlier signal failure."
+        lines.append({'id': line_id, 'name': line_name, 'modeName': 'tube', 'lineStatuses': [status]})
+    return lines
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    config = StandinConfig()
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        path = parsed.path
+
+        if path == '/v1/forecast':
+            api, build = 'forecast', lambda: forecast_payload(params)
+        elif path == '/v1/air-quality':
+            api, build = 'air-quality', lambda: air_quality_payload(params)
+        elif path.startswith('/StopPoint/') and path.endswith('/Arrivals'):
+            station_id = path.split('/')[2]
+            api, build = 'arrivals', lambda: arrivals_payload(station_id, self.config.arrivals_per_station)
+        elif path == '/Line/Mode/tube/Status':
+            api, build = 'status', line_status_payload
+        else:
+            self.send_body(404, {'error': f'no stand-in for {path}'})
+            return
+
+        self.config.count(api)
+        delay = self.config.delay()
+        if delay:
+            time.sleep(delay)
+        if self.config.should_fail():
+            self.send_body(self.config.error_status, {'error': 'injected failure'})
+            return
+        self.send_body(200, build())
+
+    def send_body(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_standins(port=0, **config):
+    """Serve the stand-ins on a background thread; returns (server, base_url)"""
+    handler = type('ConfiguredStandinHandler', (StandinHandler,), {'config': StandinConfig(**config)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='standins', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def backend_args(base_url):
+    """Command-line flags that point backend_v2.py at the stand-ins"""
+    return ['--open-meteo-url', f"{base_url}/v1/forecast",
+            '--air-quality-url', f"{base_url}/v1/air-quality",
+            '--tfl-url', base_url]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Open-Meteo and TfL stand-in server')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='mean added latency per response')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='uniform +/- jitter around the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of responses that fail')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--arrivals', type=int, default=24, help='arrivals returned per TfL station')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server, base_url = start_standins(args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                      error_rate=args.error_rate, error_status=args.error_status,
+                                      arrivals_per_station=args.arrivals, seed=args.seed)
+    print(f"Stand-ins listening on {base_url}")
+    print('Start the backend with: python backend_v2.py ' + ' '.join(backend_args(base_url)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()